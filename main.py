@@ -1,24 +1,40 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from astrbot.api.event import filter, AstrMessageEvent
 from astrbot.api.star import Context, Star, register
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw, ImageFont, ImageOps, ImageChops
 from astrbot.api.star import StarTools
+import astrbot.api.message_components as Comp
 from astrbot.api import AstrBotConfig
 from astrbot.api import logger
+from collections import OrderedDict, Counter, namedtuple
 from io import BytesIO
-import unicodedata
+import multiprocessing
 import traceback
-import platform
+import threading
 import tempfile
 import aiofiles
+import hashlib
+import sqlite3
 import asyncio
+import weakref
 import httpx
 import base64
+import struct
 import json
+import math
+import zlib
+import time
 import re
 import os
 
 @register("QQbox", "Lishining", "我想要说的,群友都替我说了!", "1.0.0")
 class QQbox(Star):
+    # 临时目录中超过该时长（秒）的文件视为遗留文件
+    TEMP_ORPHAN_AGE = 300
+    # 旧版本QQ数据中每个用户记录允许的字段
+    LEGACY_QQ_DATA_FIELDS = {"color", "content", "notes"}
+
     def __init__(self, context: Context, config: AstrBotConfig):
         super().__init__(context)
         self.Config = config
@@ -30,6 +46,37 @@ class QQbox(Star):
             self.corner_radius = 27
             logger.warning(f"配置文件中corner_radius配置出现问题:{e}")
 
+        # 头像贴图缓存大小（MB）
+        self.avatar_cache_mb = self._get_config_int("avatar_cache_mb", 16, minimum=0)
+
+        # 头像按渲染尺寸分级存储
+        self.avatar_mipmap = bool(self.Config.get("avatar_mipmap", True))
+
+        # 渲染质量预设
+        self.render_quality = str(self.Config.get("render_quality", "high"))
+
+        # 图片输入限制
+        self.image_max_mb = self._get_config_int("image_max_mb", 20, minimum=1)
+        self.image_max_megapixels = self._get_config_int("image_max_megapixels", 40, minimum=1)
+        self.image_download_concurrency = self._get_config_int("image_download_concurrency", 4, minimum=1)
+        self._image_download_semaphore = asyncio.Semaphore(self.image_download_concurrency)
+
+        # 输出编码
+        self.output_format = str(self.Config.get("output_format", "png"))
+        self.output_quality = min(self._get_config_int("output_quality", 90, minimum=1), 100)
+        self.png_compress_level = min(self._get_config_int("png_compress_level", 1, minimum=0), 9)
+
+        # 聊天记录单次合成的消息条数上限
+        self.chat_max_messages = self._get_config_int("chat_max_messages", 20, minimum=1)
+
+        # 单条消息文字数上限（0 为不限制），超出部分截断后仍生成图片
+        self.max_message_chars = self._get_config_int("max_message_chars", 5000, minimum=0)
+
+        # 渲染结果缓存
+        self.render_cache_mb = self._get_config_int("render_cache_mb", 32, minimum=0)
+        self.render_disk_cache = bool(self.Config.get("render_disk_cache", False))
+        self.render_disk_cache_ttl = self._get_config_int("render_disk_cache_ttl", 24, minimum=1)
+
         # 使用框架提供的标准数据目录
         self.data_dir = str(StarTools.get_data_dir())
 
@@ -42,28 +89,108 @@ class QQbox(Star):
         self.nickname_font_path = self._get_absolute_path(self.Config.get("nickname_font_path", ""))
         self.title_font_path = self._get_absolute_path(self.Config.get("title_font_path", ""))
 
+        # 回退字体（按顺序），主字体中没有的字符（emoji、生僻字等）依次在其中查找
+        fallback_fonts = self.Config.get("fallback_font_paths", []) or []
+        if isinstance(fallback_fonts, str):
+            fallback_fonts = [fallback_fonts]
+        self.fallback_font_paths = [self._get_absolute_path(path) for path in fallback_fonts if path]
+
         # 临时文件目录
         self.temp_path = os.path.join(self.data_dir, "temp")
 
+        # 允许读取本地图片的目录：系统临时目录、AstrBot 下载图片的 data/temp（插件数据目录为 data/plugin_data/<插件名>）与额外配置的目录
+        extra_image_dirs = self.Config.get("local_image_dirs", []) or []
+        if isinstance(extra_image_dirs, str):
+            extra_image_dirs = [extra_image_dirs]
+        self.local_image_dirs = [
+            os.path.realpath(path) for path in [
+                tempfile.gettempdir(),
+                os.path.join(os.path.dirname(os.path.dirname(self.data_dir)), "temp"),
+                self.temp_path,
+                *(self._get_absolute_path(path) for path in extra_image_dirs if path)
+            ]
+        ]
+
+        # 图片发送方式：memory 直接发送字节，file 先写入临时文件
+        self.image_delivery = str(self.Config.get("image_delivery", "memory"))
+        if self.image_delivery not in ("memory", "file"):
+            logger.warning(f"未知的图片发送方式: {self.image_delivery}，使用 memory")
+            self.image_delivery = "memory"
+
         # 创建必要的目录
         os.makedirs(self.avatar_image_path, exist_ok=True)
         os.makedirs(self.temp_path, exist_ok=True)
 
-        # QQ数据文件路径
-        self.qq_data_file = os.path.join(self._get_absolute_path(avatar_path), "qq_data.json")
+        # QQ数据文件路径（未配置头像路径时位于数据目录下的 avatars）
+        self.qq_data_file = os.path.join(self.avatar_image_path, "qq_data.json")
+        if not avatar_path:
+            self._migrate_cwd_qq_data()
 
-        # 初始化QQ数据
+        # 初始化QQ数据（修改合并后延迟写盘）
         self.qq_title_key = {}
+        self.qq_data_store = QQDataStore(
+            self.qq_data_file,
+            backend=str(self.Config.get("qq_data_backend", "json")),
+            flush_delay=self._get_config_int("qq_data_flush_delay", 2, minimum=0)
+        )
 
-        # 初始化气泡生成器
-        self.qqbox = ChatBubbleGenerator(
+        # 用户信息缓存（头像分片存放，昵称等元数据入库），过期后后台刷新
+        self.user_store = UserInfoStore(
+            self.avatar_image_path,
+            ttl=self._get_config_int("user_info_ttl_hours", 24, minimum=1) * 3600,
+            negative_ttl=self._get_config_int("user_info_negative_ttl", 300, minimum=1)
+        )
+        self._background_tasks = set()
+
+        # 同一QQ号的并发查询合并
+        self._qq_info_flight = SingleFlight()
+
+        # 相同缓存键的并发渲染合并
+        self._render_flight = SingleFlight()
+
+        # 昵称接口（按健康度排序并对冲请求）
+        self.nickname_resolver = NicknameResolver(
+            hedge_delay=self._get_config_int("nickname_hedge_ms", 800, minimum=0) / 1000
+        )
+
+        # 渲染结果缓存（内存 + 可选磁盘）
+        self.render_cache = RenderResultCache(
+            max_bytes=self.render_cache_mb * 1024 * 1024,
+            disk_dir=os.path.join(self.data_dir, "render_cache") if self.render_disk_cache else None,
+            disk_ttl=self.render_disk_cache_ttl * 3600
+        )
+
+        # 气泡生成器参数（进程后端的渲染子进程用同一份参数各自创建生成器）
+        generator_options = dict(
             bubble_font_path=self.bubble_font_path,
             nickname_font_path=self.nickname_font_path,
             title_font_path=self.title_font_path,
+            fallback_font_paths=self.fallback_font_paths,
             avatar_image_path=self.avatar_image_path,
-            corner_radius=self.corner_radius
+            corner_radius=self.corner_radius,
+            avatar_cache_bytes=self.avatar_cache_mb * 1024 * 1024,
+            avatar_mipmap=self.avatar_mipmap,
+            render_quality=self.render_quality,
+            max_image_bytes=self.image_max_mb * 1024 * 1024,
+            max_image_pixels=self.image_max_megapixels * 1_000_000,
+            output_format=self.output_format,
+            output_quality=self.output_quality,
+            png_compress_level=self.png_compress_level
+        )
+
+        # 插件专用渲染线程池 / 进程池
+        self.render_pool = RenderPool(
+            max_workers=self._get_config_int("render_workers", 2, minimum=1),
+            max_queue=self._get_config_int("render_queue_size", 8, minimum=0),
+            per_group=self._get_config_int("render_per_group", 4, minimum=0),
+            per_user=self._get_config_int("render_per_user", 2, minimum=0),
+            backend=str(self.Config.get("render_backend", "thread")),
+            worker_options=generator_options
         )
 
+        # 初始化气泡生成器
+        self.qqbox = ChatBubbleGenerator(**generator_options)
+
         # 初始化HTTP客户端（异步）
         self.http_client = None
 
@@ -74,26 +201,87 @@ class QQbox(Star):
         """异步初始化，创建HTTP客户端"""
         # 创建异步HTTP客户端
         self.http_client = httpx.AsyncClient(timeout=30.0)
-        self.qq_title_key = await self._load_qq_data()
+        self.qq_title_key = await self.qq_data_store.load()
+        await self.user_store.load()
+        await self.render_cache.sweep()
+        await asyncio.to_thread(self._sweep_temp)
         self.qqbox.is_load_fonts = await self.qqbox.load_fonts()
+        if self.qqbox.is_load_fonts:
+            warmed = await asyncio.to_thread(self.qqbox.warm_title_sprites, list(self.qq_title_key.values()))
+            logger.info(f"已预生成 {warmed} 个头衔贴图")
         logger.info("QQbox 插件初始化完成")
 
     async def terminate(self):
         """清理资源"""
         # 保存QQ数据
-        await self._save_qq_data()
+        await self.qq_data_store.close()
+
+        # 等待后台刷新结束并保存头像索引
+        if self._background_tasks:
+            await asyncio.gather(*self._background_tasks, return_exceptions=True)
+        await self.user_store.close()
+        logger.info(f"头像贴图缓存统计: {self.qqbox.avatar_tiles.stats()}")
+        logger.info(f"渲染结果缓存统计: {self.render_cache.stats()}")
+        logger.info(f"昵称接口统计: {self.nickname_resolver.stats()}")
+        logger.info(f"渲染线程池统计: {self.render_pool.stats()}")
+        logger.info(f"图片编码统计: {self.qqbox.encode_stats()}")
+        logger.info(f"头衔贴图缓存统计: {self.qqbox.title_sprite_stats()}")
+        self.render_pool.shutdown()
 
         # 关闭HTTP客户端
         if self.http_client:
             await self.http_client.aclose()
             logger.info("HTTP客户端已关闭")
 
+    def _get_config_int(self, key, default, minimum=None):
+        """读取整数配置，非法时回退默认值"""
+        try:
+            value = int(self.Config.get(key, default))
+            if minimum is not None and value < minimum:
+                raise ValueError(f"不能小于{minimum}")
+            return value
+        except Exception as e:
+            logger.warning(f"配置文件中{key}配置出现问题:{e}")
+            return default
+
     def _get_absolute_path(self, path):
         """将路径转换为绝对路径"""
         if not path:
             return ""
         return os.path.abspath(path)
 
+    def _migrate_cwd_qq_data(self):
+        """旧版本在未配置头像路径时把QQ数据写到了工作目录下的 qq_data.json。
+
+        新位置还没有数据且该文件符合QQ数据格式（QQ号 -> 头衔/备注记录）时复制一份过来，
+        原文件保持不动
+        """
+        legacy = os.path.abspath("qq_data.json")
+        db_path = os.path.splitext(self.qq_data_file)[0] + ".db"
+        if legacy == self.qq_data_file or not os.path.isfile(legacy):
+            return
+        if os.path.exists(self.qq_data_file) or os.path.exists(db_path):
+            return
+        try:
+            with open(legacy, 'r', encoding='utf-8') as f:
+                content = f.read()
+            data = json.loads(content) if content.strip() else {}
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"工作目录下的 qq_data.json 无法读取，不迁移: {legacy}, 错误: {e}")
+            return
+        if not data or not isinstance(data, dict) or not all(
+                isinstance(qq, str) and qq.isdigit()
+                and isinstance(record, dict) and set(record) <= self.LEGACY_QQ_DATA_FIELDS
+                for qq, record in data.items()
+        ):
+            logger.info(f"工作目录下的 qq_data.json 不是本插件的数据，不迁移: {legacy}")
+            return
+        try:
+            write_file_atomic(self.qq_data_file, content.encode("utf-8"))
+            logger.info(f"已从旧位置复制QQ数据（原文件保留）: {legacy} -> {self.qq_data_file}")
+        except OSError as e:
+            logger.warning(f"复制QQ数据失败: {legacy}, 错误: {e}")
+
     def _check_fonts(self):
         """检查字体文件是否存在"""
         missing_fonts = []
@@ -103,33 +291,14 @@ class QQbox(Star):
             missing_fonts.append(("昵称字体", self.nickname_font_path))
         if self.title_font_path and not os.path.exists(self.title_font_path):
             missing_fonts.append(("头衔字体", self.title_font_path))
+        for path in self.fallback_font_paths:
+            if not os.path.exists(path):
+                missing_fonts.append(("回退字体", path))
 
         if missing_fonts:
             for font_name, font_path in missing_fonts:
                 logger.warning(f"找不到{font_name}文件: {font_path}")
 
-    async def _load_qq_data(self):
-        """异步加载QQ数据"""
-        try:
-            if os.path.exists(self.qq_data_file):
-                async with aiofiles.open(self.qq_data_file, 'r', encoding='utf-8') as f:
-                    content = await f.read()
-                    if not content.strip():
-                        return {}
-                    return json.loads(content)
-            return {}
-        except (json.JSONDecodeError, OSError) as e:
-            logger.error(f"加载QQ数据失败: {e}")
-            return {}
-
-    async def _save_qq_data(self):
-        """保存QQ数据"""
-        try:
-            async with aiofiles.open(self.qq_data_file, 'w', encoding='utf-8') as f:
-                await f.write(json.dumps(self.qq_title_key, indent=4, ensure_ascii=False))
-        except OSError as e:
-            logger.error(f"保存QQ数据失败: {e}")
-
     def _validate_qq(self, qq):
         """验证QQ号是否合法（只包含数字）"""
         if not qq or not isinstance(qq, str):
@@ -148,17 +317,17 @@ class QQbox(Star):
         if not self.qqbox.is_load_fonts:
             yield event.plain_result("字体在加载中或字体没有被正确的加载,请尝试修改配置文件到正确的文字路径")
             return
-        if len(params) < 2:
+        image_sources = self._collect_image_sources(event)
+        if len(params) < 2 and not (params and image_sources):
             yield event.plain_result("请修正指令，应为 /echo [qq] [text]")
             return
-        qq, text = params[0], params[1]
+        qq = params[0]
+        text, truncated = self._truncate_text(params[1] if len(params) > 1 else "")
         if not self._validate_qq(qq):
             yield event.plain_result("QQ号格式错误，请使用纯数字")
             return
-        tmp_path = None
-
         try:
-            info = await get_qq_info(qq, self.avatar_image_path, self.http_client)
+            info = await self._get_qq_info(qq)
             if not info:
                 yield event.plain_result("获取QQ信息失败，请检查网络或稍后重试")
                 return
@@ -171,51 +340,402 @@ class QQbox(Star):
             yield event.plain_result("服务暂时不可用，请稍后重试")
             return
 
-        try:
-            img_bytes = await asyncio.to_thread(
-                self.qqbox.create_chat_message,
-                qq=qq,
-                text=text,
-                image=None,
-                qq_title_key=self.qq_title_key,
-                user_info=info
+        # 读取消息中附带或引用的图片
+        raw_image = None
+        image_digest = None
+        if image_sources:
+            try:
+                raw_image = await self._fetch_image_bytes(image_sources[0])
+                # 图片最大可达 image_max_mb，摘要在线程中计算
+                image_digest = await asyncio.to_thread(digest_bytes, raw_image)
+            except ValueError as e:
+                logger.warning(f"图片超出限制，QQ: {qq}, 错误: {e}")
+                yield event.plain_result("图片过大，请换一张图片")
+                return
+            except (httpx.HTTPError, OSError) as e:
+                logger.error(f"图片下载失败，QQ: {qq}, 错误: {e}")
+                yield event.plain_result("图片下载失败，请稍后重试")
+                return
+
+        async def render():
+            image = raw_image
+            if raw_image is not None and self.render_pool.backend != "process":
+                # 在线程中解码，避免阻塞事件循环（进程后端直接把原始字节交给子进程解码）
+                try:
+                    image = await asyncio.to_thread(self.qqbox.load_bubble_image, raw_image)
+                except ValueError as e:
+                    logger.warning(f"图片超出限制，QQ: {qq}, 错误: {e}")
+                    return None, "图片过大，请换一张图片"
+                except OSError as e:
+                    logger.error(f"图片解码失败，QQ: {qq}, 错误: {e}")
+                    return None, "图片格式不受支持"
+            spec = {
+                "qq": qq,
+                "text": text,
+                "image": image,
+                "title_info": self.qq_title_key.get(qq),
+                "user_info": {"name": info.get("name"), "avatar_path": info.get("avatar_path")}
+            }
+            return await self._render_image(spec, event, qq)
+
+        # 相同内容直接复用已渲染的图片，并发的相同请求共享同一次渲染
+        cache_key = self._render_cache_key(qq, text, image_digest, info)
+        image_data, error = await self._render_shared(cache_key, render)
+        if error:
+            yield event.plain_result(error)
+            return
+
+        async for result in self._image_results(event, image_data, qq):
+            yield result
+        if truncated:
+            yield event.plain_result(self._truncated_notice())
+
+    @filter.command("QQbox_chat")
+    async def QQbox_chat(self, event: AstrMessageEvent):
+        """多条消息合成一张聊天记录图，每行一条：[QQ号] [消息内容]"""
+        entries = extract_chat_entries(event.message_str, "QQbox_chat")
+        logger.info(f"进入QQbox_chat, 消息数: {len(entries)}")
+        if not self.qqbox.is_load_fonts:
+            yield event.plain_result("字体在加载中或字体没有被正确的加载,请尝试修改配置文件到正确的文字路径")
+            return
+        if not entries:
+            yield event.plain_result("请修正指令，应为 /QQbox_chat 后每行一条 [qq] [text]")
+            return
+        if len(entries) > self.chat_max_messages:
+            yield event.plain_result(f"一次最多合成 {self.chat_max_messages} 条消息")
+            return
+        for qq, _ in entries:
+            if not self._validate_qq(qq):
+                yield event.plain_result(f"QQ号格式错误，请使用纯数字: {qq}")
+                return
+        truncated = False
+        for index, (qq, text) in enumerate(entries):
+            text, cut = self._truncate_text(text)
+            if cut:
+                entries[index] = (qq, text)
+                truncated = True
+
+        # 去重后并发获取所有用户信息
+        unique_qqs = list(dict.fromkeys(qq for qq, _ in entries))
+        label = ",".join(unique_qqs)
+        results = await asyncio.gather(
+            *(self._get_qq_info(qq) for qq in unique_qqs),
+            return_exceptions=True
+        )
+        infos = {}
+        for qq, info in zip(unique_qqs, results):
+            if isinstance(info, Exception) or not info:
+                logger.error(f"获取QQ信息失败，QQ: {qq}, 错误: {info}")
+                yield event.plain_result(f"获取QQ信息失败: {qq}，请检查网络或稍后重试")
+                return
+            infos[qq] = info
+
+        # 只写了QQ号的行依次使用消息中附带或引用的图片
+        image_sources = self._collect_image_sources(event)
+        image_slots = [index for index, (_, text) in enumerate(entries) if not text]
+        raw_images = [None] * len(entries)
+        if image_sources and image_slots:
+            pairs = list(zip(image_slots, image_sources))
+            fetched = await asyncio.gather(
+                *(self._fetch_image_bytes(source) for _, source in pairs),
+                return_exceptions=True
             )
-        except (MemoryError, OSError) as e:
-            logger.error(f"图片生成失败，QQ: {qq}, 错误类型: {type(e).__name__}, 详情: {e}")
-            yield event.plain_result("图片生成失败，可能是内存不足或系统资源限制")
+            for (index, _), data in zip(pairs, fetched):
+                if isinstance(data, ValueError):
+                    logger.warning(f"图片超出限制，QQ: {entries[index][0]}, 错误: {data}")
+                    yield event.plain_result("图片过大，请换一张图片")
+                    return
+                if isinstance(data, Exception):
+                    logger.error(f"图片下载失败，QQ: {entries[index][0]}, 错误: {data}")
+                    yield event.plain_result("图片下载失败，请稍后重试")
+                    return
+                raw_images[index] = data
+
+        # 整段聊天记录的缓存键由每条消息的缓存键组成
+        digests = await asyncio.to_thread(lambda: [digest_bytes(data) for data in raw_images])
+        cache_key = RenderResultCache.make_key(conversation=[
+            self._render_cache_key(qq, text, digest, infos[qq])
+            for (qq, text), digest in zip(entries, digests)
+        ])
+
+        async def render():
+            spec = {"messages": [
+                {
+                    "qq": qq,
+                    "text": text,
+                    "image": raw_image,
+                    "title_info": self.qq_title_key.get(qq),
+                    "user_info": {"name": infos[qq].get("name"), "avatar_path": infos[qq].get("avatar_path")}
+                }
+                for (qq, text), raw_image in zip(entries, raw_images)
+            ]}
+            return await self._render_image(spec, event, label)
+
+        image_data, error = await self._render_shared(cache_key, render)
+        if error:
+            yield event.plain_result(error)
             return
+
+        async for result in self._image_results(event, image_data, label):
+            yield result
+        if truncated:
+            yield event.plain_result(self._truncated_notice())
+
+    def _truncate_text(self, text):
+        """超过 max_message_chars 时截断并加省略号，返回 (文本, 是否截断)"""
+        if self.max_message_chars and len(text) > self.max_message_chars:
+            return text[:self.max_message_chars] + "……", True
+        return text, False
+
+    def _truncated_notice(self):
+        return f"消息过长，只生成了前 {self.max_message_chars} 个字"
+
+    async def _render_shared(self, cache_key, render):
+        """先查结果缓存，未命中时相同缓存键的并发请求共享同一次 render()，返回 (图片字节, 回复文本)"""
+        image_data = await self.render_cache.get(cache_key)
+        if image_data is not None:
+            return image_data, None
+
+        async def render_and_cache():
+            # 上一次相同渲染可能刚结束并写入缓存
+            image_data = await self.render_cache.get(cache_key)
+            if image_data is not None:
+                return image_data, None
+            image_data, error = await render()
+            if error is None:
+                await self.render_cache.put(cache_key, image_data)
+            return image_data, error
+
+        return await self._render_flight.do(cache_key, render_and_cache)
+
+    async def _render_image(self, spec, event, label):
+        """渲染并返回 (图片字节, None)；失败时返回 (None, 回复文本)"""
+        try:
+            return await self._render(spec, event), None
+        except RenderBusyError as e:
+            logger.warning(f"渲染繁忙，QQ: {label}, 原因: {e}")
+            return None, "当前生成的图片太多啦，请稍后再试"
+        except BrokenProcessPool as e:
+            logger.error(f"渲染子进程异常退出，QQ: {label}, 错误: {e}")
+            return None, "图片生成失败，请稍后重试"
+        except ConversationTooLargeError as e:
+            logger.warning(f"聊天记录过长，QQ: {label}, 错误: {e}")
+            return None, "聊天记录过长，请减少消息数量"
+        except ValueError as e:
+            logger.warning(f"图片超出限制，QQ: {label}, 错误: {e}")
+            return None, "图片过大，请换一张图片"
+        except Image.UnidentifiedImageError as e:
+            logger.error(f"图片解码失败，QQ: {label}, 错误: {e}")
+            return None, "图片格式不受支持"
+        except (MemoryError, OSError) as e:
+            logger.error(f"图片生成失败，QQ: {label}, 错误类型: {type(e).__name__}, 详情: {e}")
+            return None, "图片生成失败，可能是内存不足或系统资源限制"
         except ImportError as e:
             logger.error(f"依赖库错误: {e}\n{traceback.format_exc()}")
-            yield event.plain_result("系统组件异常，请联系管理员")
-            return
+            return None, "系统组件异常，请联系管理员"
 
-        try:
-            image_data = img_bytes.getvalue()
-        except (IOError, OSError) as e:
-            logger.error(f"图片保存失败，QQ: {qq}, 错误: {e}")
-            yield event.plain_result("图片处理失败，请稍后重试")
-            return
+    async def _image_results(self, event, image_data, label):
+        """生成发送图片的消息结果"""
+        # 默认直接发送内存中的图片字节，不经过磁盘
+        if self.image_delivery == "memory":
+            try:
+                result = event.chain_result([Comp.Image.fromBytes(image_data)])
+            except Exception as e:
+                logger.warning(f"内存发送图片不可用，改用临时文件，错误: {e}")
+            else:
+                yield result
+                return
 
+        # 回退：写入临时文件后发送
         try:
-            fd, tmp_path = tempfile.mkstemp(suffix='.png', dir=self.temp_path)
-            with os.fdopen(fd, 'wb') as f:
-                f.write(image_data)
+            tmp_path = await asyncio.to_thread(self._write_temp_image, image_data)
         except (OSError, IOError) as e:
-            logger.error(f"临时文件创建失败，QQ: {qq}, 错误: {e}")
+            logger.error(f"临时文件创建失败，QQ: {label}, 错误: {e}")
             yield event.plain_result("文件操作失败，请检查磁盘空间")
-            self.clear_temp(tmp_path)
             return
 
         try:
             yield event.make_result().file_image(tmp_path)
         except Exception as e:
-            logger.error(f"消息发送失败，QQ: {qq}, 错误类型: {type(e).__name__}")
+            logger.error(f"消息发送失败，QQ: {label}, 错误类型: {type(e).__name__}")
             yield event.plain_result("消息发送失败，请稍后重试")
             self.clear_temp(tmp_path)
             return
 
         self.clear_temp(tmp_path)
 
+    async def _get_qq_info(self, qq):
+        """获取QQ信息，同一QQ号的并发查询共享同一次请求；缓存过期时先返回旧数据再后台刷新"""
+        info = await self._qq_info_flight.do(qq, lambda: self._fetch_qq_info(qq))
+        if info and info.get("stale"):
+            self._refresh_qq_info(qq)
+        return info
+
+    def _fetch_qq_info(self, qq, refresh=False):
+        return get_qq_info(
+            qq,
+            self.avatar_image_path,
+            self.http_client,
+            self.user_store,
+            mip_sizes=self.qqbox.avatar_mip_sizes(),
+            nickname_resolver=self.nickname_resolver,
+            refresh=refresh
+        )
+
+    def _refresh_qq_info(self, qq):
+        """在后台刷新过期的QQ信息，同一QQ号同时只刷新一次"""
+        key = ("refresh", qq)
+        if self._qq_info_flight.in_flight(key):
+            return
+        task = asyncio.ensure_future(
+            self._qq_info_flight.do(key, lambda: self._fetch_qq_info(qq, refresh=True))
+        )
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def _render(self, spec, event):
+        """在渲染线程池 / 进程池中生成图片，返回编码后的字节"""
+        if self.render_pool.backend == "process":
+            func = _render_worker_task
+        else:
+            func = self.qqbox.render_spec
+        return await self.render_pool.run(
+            func,
+            spec,
+            group=self._event_group(event),
+            user=self._event_user(event)
+        )
+
+    def _event_group(self, event):
+        """渲染并发限制使用的群标识，私聊时按会话区分"""
+        try:
+            return event.get_group_id() or event.unified_msg_origin
+        except Exception:
+            return None
+
+    def _event_user(self, event):
+        """渲染并发限制使用的用户标识"""
+        try:
+            return event.get_sender_id()
+        except Exception:
+            return None
+
+    def _collect_image_sources(self, event):
+        """收集触发消息及其引用消息中的图片地址"""
+        sources = []
+
+        def walk(components):
+            for comp in components or []:
+                if isinstance(comp, Comp.Image):
+                    source = getattr(comp, "url", None) or getattr(comp, "file", None)
+                    if source:
+                        sources.append(source)
+                elif isinstance(comp, Comp.Reply):
+                    walk(getattr(comp, "chain", None))
+
+        try:
+            walk(event.get_messages())
+        except Exception as e:
+            logger.warning(f"解析消息图片失败: {e}")
+        return sources
+
+    def _resolve_local_image(self, source):
+        """本地图片路径：解析符号链接后必须位于允许的目录内，否则抛出 PermissionError"""
+        path = source[len("file://"):] if source.startswith("file://") else source
+        real_path = os.path.realpath(path)
+        for directory in self.local_image_dirs:
+            try:
+                if os.path.commonpath([real_path, directory]) == directory:
+                    return real_path
+            except ValueError:
+                # 不同盘符等无法比较的路径
+                continue
+        logger.warning(f"拒绝读取允许目录之外的本地图片: {path}")
+        raise PermissionError(f"不允许读取的图片路径: {path}")
+
+    async def _fetch_image_bytes(self, source):
+        """获取图片原始字节：网络图片通过共享客户端流式下载，超出大小上限时抛出 ValueError"""
+        max_bytes = self.image_max_mb * 1024 * 1024
+
+        if source.startswith("base64://"):
+            data = base64.b64decode(source[len("base64://"):])
+        elif source.startswith(("http://", "https://")):
+            if self.http_client is None:
+                raise OSError("HTTP客户端未初始化")
+            async with self._image_download_semaphore:
+                async with self.http_client.stream("GET", source, timeout=15.0) as response:
+                    response.raise_for_status()
+                    length = response.headers.get("Content-Length")
+                    if length and length.isdigit() and int(length) > max_bytes:
+                        raise ValueError(f"图片过大: {length} 字节")
+                    chunks = []
+                    total = 0
+                    async for chunk in response.aiter_bytes():
+                        total += len(chunk)
+                        if total > max_bytes:
+                            raise ValueError(f"图片超过 {max_bytes} 字节")
+                        chunks.append(chunk)
+                    data = b"".join(chunks)
+        else:
+            path = self._resolve_local_image(source)
+            if os.path.getsize(path) > max_bytes:
+                raise ValueError(f"图片超过 {max_bytes} 字节")
+            async with aiofiles.open(path, 'rb') as f:
+                data = await f.read()
+
+        if len(data) > max_bytes:
+            raise ValueError(f"图片超过 {max_bytes} 字节")
+        return data
+
+    def _render_cache_key(self, qq, text, image_digest, info):
+        """渲染结果缓存键：覆盖所有会影响输出图片的输入"""
+        avatar_path = info.get("avatar_path")
+        try:
+            stat = os.stat(avatar_path)
+            avatar_version = (avatar_path, info.get("avatar_hash"), stat.st_mtime_ns, stat.st_size)
+        except (OSError, TypeError):
+            avatar_version = None
+        return RenderResultCache.make_key(
+            qq=qq,
+            text=text,
+            image=image_digest,
+            name=info.get("name"),
+            title=self.qq_title_key.get(str(qq)),
+            avatar=avatar_version,
+            style=self.qqbox.style_fingerprint()
+        )
+
+    def _write_temp_image(self, image_data):
+        """将图片写入临时文件，返回文件路径"""
+        fd, tmp_path = tempfile.mkstemp(suffix=self.qqbox.output_extension, dir=self.temp_path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(image_data)
+        except BaseException:
+            self.clear_temp(tmp_path)
+            raise
+        return tmp_path
+
+    def _sweep_temp(self, max_age=TEMP_ORPHAN_AGE):
+        """清理上次运行遗留的临时文件（发送中途崩溃或重启时未删除的文件）"""
+        removed = 0
+        now = time.time()
+        try:
+            entries = list(os.scandir(self.temp_path))
+        except OSError as e:
+            logger.warning(f"扫描临时目录失败: {e}")
+            return 0
+        for entry in entries:
+            try:
+                if entry.is_file() and now - entry.stat().st_mtime > max_age:
+                    os.unlink(entry.path)
+                    removed += 1
+            except OSError as e:
+                logger.warning(f"清理临时文件失败: {e}")
+        if removed:
+            logger.info(f"已清理 {removed} 个遗留临时文件")
+        return removed
+
     def clear_temp(self, tmp_path):
         if tmp_path and os.path.exists(tmp_path):
             try:
@@ -284,6 +804,7 @@ class QQbox(Star):
 1. 生成聊天气泡
    命令：/QQbox_echo [QQ号] [消息内容]
    说明：生成指定QQ用户发送消息的气泡图片
+   附带或引用一张图片时生成图片 / 图文气泡
 
 2. 设置头衔颜色
    命令：/QQbox_color [QQ号] [颜色编号]
@@ -302,6 +823,11 @@ class QQbox(Star):
    命令：/QQbox_note [QQ号] [备注名]
    说明：设置用户的显示备注名（会覆盖原昵称）
 
+5. 生成聊天记录
+   命令：/QQbox_chat 换行后每行一条 [QQ号] [消息内容]
+   说明：把多条消息按顺序合成一张聊天记录图片
+   只写QQ号的行依次使用消息中附带或引用的图片
+
 注意：所有QQ号都必须是纯数字格式"""
         yield event.plain_result(help_text)
 
@@ -317,7 +843,7 @@ class QQbox(Star):
         else:
             self.qq_title_key[qq_str]["notes"] = note
 
-        await self._save_qq_data()
+        self.qq_data_store.mark_dirty(qq_str)
 
     async def _set_title_color(self, qq, color_id):
         """设置头衔颜色"""
@@ -333,9 +859,12 @@ class QQbox(Star):
                 "notes": None
             }
         else:
+            old_title = dict(self.qq_title_key[qq_str])
             self.qq_title_key[qq_str]["color"] = color_clean
+            self._forget_title_sprite(old_title)
 
-        await self._save_qq_data()
+        self.qq_data_store.mark_dirty(qq_str)
+        await self._warm_title_sprite(qq_str)
 
     async def _set_title_name(self, qq, title):
         """设置头衔名称"""
@@ -347,14 +876,1301 @@ class QQbox(Star):
                 "notes": None
             }
         else:
+            old_title = dict(self.qq_title_key[qq_str])
             self.qq_title_key[qq_str]["content"] = title
+            self._forget_title_sprite(old_title)
+
+        self.qq_data_store.mark_dirty(qq_str)
+        await self._warm_title_sprite(qq_str)
+
+    def _forget_title_sprite(self, old_title):
+        """头衔修改后，若旧头衔已无人使用则移除其贴图"""
+        old = self.qqbox.resolve_title(old_title)
+        if old is None:
+            return
+        for title_info in self.qq_title_key.values():
+            if self.qqbox.resolve_title(title_info) == old:
+                return
+        self.qqbox.invalidate_title_sprites(*old)
+
+    async def _warm_title_sprite(self, qq_str):
+        """预先生成修改后的头衔贴图"""
+        if self.qqbox.is_load_fonts:
+            await asyncio.to_thread(self.qqbox.warm_title_sprites, [self.qq_title_key[qq_str]])
+
+# ------------------------------------------------------------------------------
+# QQ数据持久化
+# ------------------------------------------------------------------------------
+class QQDataStore:
+    """qq_title_key 持久化：短时间内的多次修改合并后再写盘，JSON 后端写临时文件后替换，
+    SQLite（WAL）后端只写入被修改的用户"""
+
+    BACKENDS = ("json", "sqlite")
+
+    def __init__(self, json_path, backend="json", flush_delay=2.0):
+        if backend not in self.BACKENDS:
+            logger.warning(f"未知的QQ数据存储方式: {backend}，使用 json")
+            backend = "json"
+        self.json_path = json_path
+        self.db_path = os.path.splitext(json_path)[0] + ".db"
+        self.backend = backend
+        self.flush_delay = flush_delay
+        self.data = {}
+        self._dirty = set()
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+        self._closed = False
+        self._conn = None
+
+    async def load(self):
+        """加载QQ数据，返回之后需原地修改的字典"""
+        if self.backend == "sqlite":
+            self.data = await asyncio.to_thread(self._load_sqlite)
+        else:
+            self.data = await self._load_json()
+        return self.data
+
+    def mark_dirty(self, qq):
+        """记录被修改的用户，延迟 flush_delay 秒后统一写盘"""
+        self._dirty.add(qq)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._delayed_flush())
+
+    async def flush(self):
+        """立即写入所有未保存的修改"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, set()
+            # 在事件循环上只复制各用户记录（之后会被原地修改），序列化与写盘都在线程中进行
+            try:
+                if self.backend == "sqlite":
+                    records = [(qq, self._snapshot(self.data[qq]) if qq in self.data else None) for qq in dirty]
+                    await asyncio.to_thread(self._write_sqlite, records)
+                else:
+                    snapshot = {qq: self._snapshot(record) for qq, record in self.data.items()}
+                    await asyncio.to_thread(self._write_json, snapshot)
+            except (OSError, sqlite3.Error) as e:
+                self._dirty |= dirty
+                logger.error(f"保存QQ数据失败: {e}")
+
+    async def close(self):
+        """等待进行中的写盘结束（仍在延迟等待时直接取消）后立即保存"""
+        self._closed = True
+        task = self._flush_task
+        if task is not None and not task.done():
+            if self._flush_lock.locked():
+                # 正在写盘，取消会在后台线程写入时关闭数据库连接
+                await task
+            else:
+                task.cancel()
+        await self.flush()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_delay)
+        await self.flush()
+        # 写盘期间到达的修改不会触发新的定时（本任务尚未结束），在这里补上
+        if self._dirty and not self._closed:
+            self._flush_task = asyncio.ensure_future(self._delayed_flush())
+
+    async def _load_json(self):
+        """异步加载QQ数据"""
+        try:
+            if os.path.exists(self.json_path):
+                async with aiofiles.open(self.json_path, 'r', encoding='utf-8') as f:
+                    content = await f.read()
+                    if not content.strip():
+                        return {}
+                    return json.loads(content)
+            return {}
+        except (json.JSONDecodeError, OSError) as e:
+            logger.error(f"加载QQ数据失败: {e}")
+            return {}
+
+    def _load_sqlite(self):
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS qq_data (qq TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self._conn.commit()
+        rows = self._conn.execute("SELECT qq, data FROM qq_data").fetchall()
+        if not rows and os.path.exists(self.json_path):
+            # 首次切换到 SQLite 时导入已有的 JSON 数据
+            try:
+                with open(self.json_path, 'r', encoding='utf-8') as f:
+                    content = f.read()
+                imported = json.loads(content) if content.strip() else {}
+            except (json.JSONDecodeError, OSError) as e:
+                logger.error(f"导入QQ数据失败: {e}")
+                imported = {}
+            self._write_sqlite(list(imported.items()))
+            logger.info(f"已将 {len(imported)} 条QQ数据导入 SQLite")
+            return imported
+        return {qq: json.loads(data) for qq, data in rows}
+
+    @staticmethod
+    def _snapshot(record):
+        return dict(record) if isinstance(record, dict) else record
+
+    def _write_json(self, snapshot):
+        content = json.dumps(snapshot, indent=4, ensure_ascii=False)
+        write_file_atomic(self.json_path, content.encode("utf-8"))
+
+    def _write_sqlite(self, records):
+        """records 为 [(QQ号, 记录)]，记录为 None 表示删除"""
+        rows = [
+            (qq, json.dumps(record, ensure_ascii=False) if record is not None else None)
+            for qq, record in records
+        ]
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO qq_data (qq, data) VALUES (?, ?)",
+                [row for row in rows if row[1] is not None]
+            )
+            self._conn.executemany(
+                "DELETE FROM qq_data WHERE qq = ?",
+                [(row[0],) for row in rows if row[1] is None]
+            )
+
+# ------------------------------------------------------------------------------
+# 并发请求合并
+# ------------------------------------------------------------------------------
+class SingleFlight:
+    """相同键的并发调用只执行一次，结果或异常分发给所有等待者"""
+
+    def __init__(self):
+        self._inflight = {}
+
+    async def do(self, key, factory):
+        """执行 factory() 返回的协程；已有相同键的调用在进行时直接等待其结果"""
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(factory())
+            self._inflight[key] = future
+            future.add_done_callback(lambda f: self._finish(key, f))
+        # shield：单个等待者被取消不影响其他等待者
+        return await asyncio.shield(future)
+
+    def in_flight(self, key):
+        return key in self._inflight
+
+    def _finish(self, key, future):
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        # 所有等待者都已取消时也要取走异常，避免未处理异常警告
+        if not future.cancelled():
+            future.exception()
+
+# ------------------------------------------------------------------------------
+# 昵称接口解析
+# ------------------------------------------------------------------------------
+class NicknameEndpoint:
+    """单个昵称接口及其健康统计"""
+
+    def __init__(self, name, url_template):
+        self.name = name
+        self.url_template = url_template
+        self.latency = None  # 成功请求耗时的指数移动平均（秒）
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0  # 熔断截止时间
+
+    def url(self, qq):
+        return self.url_template.format(qq=qq)
+
+    def success_rate(self):
+        # 加一平滑，新接口视为 50%
+        return (self.successes + 1) / (self.successes + self.failures + 2)
+
+    def score(self, default_latency):
+        """越小越优先：预期耗时 / 成功率"""
+        latency = self.latency if self.latency is not None else default_latency
+        return latency / self.success_rate()
+
+    def record_success(self, elapsed):
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.latency = elapsed if self.latency is None else self.latency * 0.7 + elapsed * 0.3
+
+    def record_lower_bound(self, elapsed):
+        """请求被取消时只知道耗时不少于 elapsed，仅在比当前估计更慢时修正"""
+        if self.latency is None or elapsed > self.latency:
+            self.latency = elapsed if self.latency is None else self.latency * 0.7 + elapsed * 0.3
+
+    def record_failure(self, threshold, cooldown):
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= threshold:
+            self.open_until = time.monotonic() + cooldown
+
+class NicknameResolver:
+    """并发对冲的昵称查询：按健康度排序接口，延迟一段时间仍无结果时并行请求下一个，
+    取第一个有效结果并取消其余请求；连续失败的接口会被熔断一段时间"""
+
+    DEFAULT_ENDPOINTS = (
+        ("uapis", "https://uapis.cn/api/v1/social/qq/userinfo?qq={qq}"),
+        ("mmp", "https://api.mmp.cc/api/qqname?qq={qq}"),
+        ("uomg", "https://api.uomg.com/api/qq.info?qq={qq}"),
+        # 可以添加更多备用API
+    )
+
+    def __init__(
+            self,
+            endpoints=None,
+            hedge_delay=0.8,
+            timeout=10.0,
+            failure_threshold=3,
+            cooldown=60.0
+    ):
+        self.endpoints = [
+            NicknameEndpoint(name, url) for name, url in (endpoints or self.DEFAULT_ENDPOINTS)
+        ]
+        self.hedge_delay = hedge_delay
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+    def ranked(self):
+        """按健康度排序的可用接口；全部熔断时按最早恢复的顺序半开尝试"""
+        now = time.monotonic()
+        available = [ep for ep in self.endpoints if ep.open_until <= now]
+        if not available:
+            return sorted(self.endpoints, key=lambda ep: ep.open_until)
+        # 稳定排序，未测过的接口保持配置顺序
+        return sorted(available, key=lambda ep: ep.score(self.timeout / 10))
+
+    async def resolve(self, qq, http_client):
+        """返回昵称，全部接口失败时返回 None"""
+        queue = self.ranked()
+        tasks = set()
+        try:
+            while queue or tasks:
+                if queue:
+                    endpoint = queue.pop(0)
+                    tasks.add(asyncio.ensure_future(self._query(endpoint, qq, http_client)))
+                # 还有后备接口时只等待对冲间隔，否则等到有结果为止
+                done, tasks = await asyncio.wait(
+                    tasks,
+                    timeout=self.hedge_delay if queue else None,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    nickname = task.result()
+                    if nickname:
+                        return nickname
+            return None
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _query(self, endpoint, qq, http_client):
+        start = time.monotonic()
+        try:
+            response = await http_client.get(endpoint.url(qq), timeout=self.timeout)
+            nickname = None
+            if response.status_code == 200:
+                nickname = self.parse_nickname(response.json())
+        except asyncio.CancelledError:
+            # 被对冲取消：记录耗时下限；超过对冲间隔仍无结果的计为一次失败，
+            # 否则一直挂起的接口永远不会被熔断
+            elapsed = time.monotonic() - start
+            endpoint.record_lower_bound(elapsed)
+            if elapsed >= max(self.hedge_delay, self.timeout / 10):
+                endpoint.record_failure(self.failure_threshold, self.cooldown)
+            raise
+        except Exception as e:
+            logger.debug(f"API请求失败 {endpoint.name}: {e}")
+            nickname = None
+
+        if nickname:
+            endpoint.record_success(time.monotonic() - start)
+        else:
+            endpoint.record_failure(self.failure_threshold, self.cooldown)
+        return nickname
+
+    @staticmethod
+    def parse_nickname(data):
+        """尝试解析不同API的响应格式"""
+        if not isinstance(data, dict):
+            return None
+        if isinstance(data.get("data"), dict) and data["data"].get("name"):
+            nickname = data["data"]["name"]
+        elif data.get("name"):
+            nickname = data["name"]
+        elif data.get("nickname"):
+            nickname = data["nickname"]
+        else:
+            return None
+        return str(nickname)
+
+    def stats(self):
+        return {
+            ep.name: {
+                "latency": round(ep.latency, 3) if ep.latency is not None else None,
+                "successes": ep.successes,
+                "failures": ep.failures,
+                "open": ep.open_until > time.monotonic()
+            }
+            for ep in self.endpoints
+        }
+
+# ------------------------------------------------------------------------------
+# 用户信息缓存
+# ------------------------------------------------------------------------------
+class UserInfoStore:
+    """用户信息缓存：头像按QQ号分片存放（store/{末两位}/{qq}.png），
+    昵称、获取时间、头像哈希等元数据保存在 SQLite 索引中，与头像文件互不影响
+
+    每条记录带有过期时间：过期的记录仍可立即使用，同时由调用方在后台刷新；
+    连续失败的查询按指数退避短暂缓存，避免每次都以完整代价重试。
+    """
+
+    DB_NAME = "user_info.db"
+    LEGACY_MANIFEST = "avatar_index.json"
+    LAYOUT_VERSION = "2"
+
+    def __init__(self, avatar_dir, ttl=86400, negative_ttl=300):
+        self.avatar_dir = avatar_dir
+        self.db_path = os.path.join(avatar_dir, self.DB_NAME)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._conn = None
+        self._db_lock = threading.Lock()
+        self._entries = {}
+        self._pending = {}
+        self._negative = {}
+        self._save_lock = asyncio.Lock()
+
+    async def load(self):
+        """打开索引库，首次启动时迁移旧版 {qq}-{昵称}.png 缓存"""
+        await asyncio.to_thread(self._open)
+        migrated = await asyncio.to_thread(self._migrate_legacy)
+        if migrated:
+            logger.info(f"已迁移旧版头像缓存 {migrated} 条")
+        self._entries = await asyncio.to_thread(self._read_all)
+
+    async def close(self):
+        await self.save()
+        with self._db_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def avatar_path(self, qq):
+        return avatar_store_path(self.avatar_dir, qq)
+
+    def lookup(self, qq):
+        """按QQ号查询缓存，返回 (用户信息, 是否未过期)；头像文件已被删除时移除对应记录"""
+        entry = self._entries.get(qq)
+        if not entry:
+            return None, False
+        avatar_path = self.avatar_path(qq)
+        if not os.path.exists(avatar_path):
+            del self._entries[qq]
+            self._pending[qq] = None
+            return None, False
+        info = {
+            "qq": qq,
+            "name": entry.get("nickname") or qq,
+            "avatar_path": avatar_path,
+            "avatar_hash": entry.get("avatar_hash")
+        }
+        return info, time.time() < (entry.get("expires_at") or 0)
+
+    def validators(self, qq):
+        """上次下载头像时的 ETag / Last-Modified"""
+        entry = self._entries.get(qq) or {}
+        return entry.get("etag"), entry.get("last_modified")
+
+    def put(self, qq, nickname, ok=True, etag=None, last_modified=None, avatar_hash=None):
+        """登记查询结果；ok 为 False 表示昵称或头像获取失败，只短暂缓存"""
+        now = time.time()
+        previous = self._entries.get(qq) or {}
+        failures = 0 if ok else (previous.get("failures") or 0) + 1
+        entry = {
+            "nickname": nickname,
+            "avatar_hash": avatar_hash,
+            "fetched_at": now,
+            "expires_at": now + (self.ttl if ok else self._backoff(failures)),
+            "etag": etag,
+            "last_modified": last_modified,
+            "failures": failures
+        }
+        self._entries[qq] = entry
+        self._pending[qq] = entry
+        self._negative.pop(qq, None)
+
+    def is_negative(self, qq):
+        """查询是否仍处于失败冷却期"""
+        entry = self._negative.get(qq)
+        return entry is not None and time.time() < entry[0]
+
+    def mark_failure(self, qq):
+        """记录一次查询失败：已有记录时推迟其下次刷新，否则进入短期失败缓存"""
+        now = time.time()
+        entry = self._entries.get(qq)
+        if entry is not None:
+            entry["failures"] = (entry.get("failures") or 0) + 1
+            entry["expires_at"] = now + self._backoff(entry["failures"])
+            self._pending[qq] = entry
+            return
+        _, failures = self._negative.get(qq, (0, 0))
+        failures += 1
+        self._negative[qq] = (now + self._backoff(failures), failures)
+
+    def _backoff(self, failures):
+        return min(self.negative_ttl * 2 ** max(failures - 1, 0), self.ttl)
+
+    async def save(self):
+        """将变更的记录写入索引库（单条 upsert，与总用户数无关）"""
+        if not self._pending:
+            return
+        async with self._save_lock:
+            pending, self._pending = self._pending, {}
+            try:
+                await asyncio.to_thread(self._write_rows, pending)
+            except sqlite3.Error as e:
+                # 写入失败的记录留到下次保存
+                for qq, entry in pending.items():
+                    self._pending.setdefault(qq, entry)
+                logger.error(f"保存用户信息失败: {e}")
+
+    # ------------------------------------------------------------------------------
+    # SQLite 读写（均在线程中执行）
+    # ------------------------------------------------------------------------------
+    _COLUMNS = ("nickname", "avatar_hash", "fetched_at", "expires_at", "etag", "last_modified", "failures")
+
+    def _open(self):
+        os.makedirs(self.avatar_dir, exist_ok=True)
+        with self._db_lock:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                "qq TEXT PRIMARY KEY, nickname TEXT, avatar_hash TEXT, fetched_at REAL, "
+                "expires_at REAL, etag TEXT, last_modified TEXT, failures INTEGER DEFAULT 0)"
+            )
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self._conn.commit()
+
+    def _read_all(self):
+        with self._db_lock:
+            rows = self._conn.execute(f"SELECT qq, {', '.join(self._COLUMNS)} FROM users").fetchall()
+        return {row[0]: dict(zip(self._COLUMNS, row[1:])) for row in rows}
+
+    def _write_rows(self, pending):
+        upserts = [
+            (qq, *(entry.get(column) for column in self._COLUMNS))
+            for qq, entry in pending.items() if entry is not None
+        ]
+        deletes = [(qq,) for qq, entry in pending.items() if entry is None]
+        placeholders = ", ".join("?" * (len(self._COLUMNS) + 1))
+        with self._db_lock:
+            with self._conn:
+                if upserts:
+                    self._conn.executemany(
+                        f"INSERT OR REPLACE INTO users (qq, {', '.join(self._COLUMNS)}) VALUES ({placeholders})",
+                        upserts
+                    )
+                if deletes:
+                    self._conn.executemany("DELETE FROM users WHERE qq = ?", deletes)
+
+    def _migrate_legacy(self):
+        """一次性迁移：把 {qq}-{昵称}.png 移入分片目录，昵称与时间写入索引库"""
+        with self._db_lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'layout'").fetchone()
+        if row and row[0] == self.LAYOUT_VERSION:
+            return 0
+
+        manifest = self._read_legacy_manifest()
+
+        # 按QQ号收集旧文件，清单中记录的优先，其余取最新的一份
+        candidates = {}
+        with os.scandir(self.avatar_dir) as it:
+            for entry in it:
+                parsed = parse_avatar_filename(entry.name)
+                if parsed and entry.is_file():
+                    candidates.setdefault(parsed[0], []).append((entry.stat().st_mtime, entry.name, parsed[1]))
+
+        mip_root = os.path.join(self.avatar_dir, "mip")
+        mip_sizes = [name for name in os.listdir(mip_root) if name.isdigit()] if os.path.isdir(mip_root) else []
+
+        rows = []
+        for qq, files in candidates.items():
+            files.sort(reverse=True)
+            listed = (manifest.get(qq) or {}).get("file")
+            chosen = next((f for f in files if f[1] == listed), files[0])
+            mtime, filename, nickname = chosen
+            legacy = manifest.get(qq) or {}
+
+            src = os.path.join(self.avatar_dir, filename)
+            dst = self.avatar_path(qq)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            os.replace(src, dst)
+            # 摘要与正常保存时一致，取自文件内容，避免首次刷新时被当作变化
+            with open(dst, "rb") as f:
+                avatar_hash = digest_bytes(f.read())
+            for size in mip_sizes:
+                old_mip = os.path.join(mip_root, size, filename)
+                if os.path.exists(old_mip):
+                    new_mip = avatar_mip_path(dst, size)
+                    os.makedirs(os.path.dirname(new_mip), exist_ok=True)
+                    os.replace(old_mip, new_mip)
+
+            # 同一QQ号的其余旧文件都是过时的缓存
+            for _, duplicate, _ in files:
+                if duplicate != filename:
+                    for path in [os.path.join(self.avatar_dir, duplicate)] + [
+                        os.path.join(mip_root, size, duplicate) for size in mip_sizes
+                    ]:
+                        if os.path.exists(path):
+                            os.unlink(path)
+
+            fetched_at = legacy.get("fetched_at", mtime)
+            rows.append((
+                qq, nickname, avatar_hash, fetched_at, legacy.get("expires_at", fetched_at + self.ttl),
+                legacy.get("etag"), legacy.get("last_modified"), legacy.get("failures") or 0
+            ))
+
+        placeholders = ", ".join("?" * (len(self._COLUMNS) + 1))
+        with self._db_lock:
+            with self._conn:
+                self._conn.executemany(
+                    f"INSERT OR IGNORE INTO users (qq, {', '.join(self._COLUMNS)}) VALUES ({placeholders})",
+                    rows
+                )
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('layout', ?)",
+                    (self.LAYOUT_VERSION,)
+                )
+
+        legacy_manifest = os.path.join(self.avatar_dir, self.LEGACY_MANIFEST)
+        if os.path.exists(legacy_manifest):
+            os.unlink(legacy_manifest)
+        for directory in [os.path.join(mip_root, size) for size in mip_sizes] + [mip_root]:
+            try:
+                os.rmdir(directory)
+            except OSError:
+                pass
+        return len(rows)
+
+    def _read_legacy_manifest(self):
+        try:
+            with open(os.path.join(self.avatar_dir, self.LEGACY_MANIFEST), 'r', encoding='utf-8') as f:
+                entries = json.load(f).get("entries")
+        except (OSError, ValueError, AttributeError):
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        result = {}
+        for qq, entry in entries.items():
+            # 旧版清单只记录文件名，视为已过期
+            if isinstance(entry, str):
+                entry = {"file": entry, "fetched_at": 0, "expires_at": 0}
+            if isinstance(entry, dict):
+                result[str(qq)] = entry
+        return result
+
+# ------------------------------------------------------------------------------
+# 头像贴图缓存
+# ------------------------------------------------------------------------------
+class AvatarTileCache:
+    """已解码、已缩放的RGBA头像贴图LRU缓存，按字节预算淘汰，文件变化时自动失效"""
+
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._tiles = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, size):
+        """获取可直接粘贴的头像贴图，文件不存在时返回 None"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        signature = (stat.st_mtime_ns, stat.st_size)
+        key = (path, tuple(size))
+
+        with self._lock:
+            entry = self._tiles.get(key)
+            if entry is not None and entry[0] == signature:
+                self._tiles.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        with Image.open(path) as img:
+            tile = img.convert("RGBA")
+        if tile.size != tuple(size):
+            tile = tile.resize(size, Image.Resampling.LANCZOS)
+        self._store(key, signature, tile)
+        return tile
+
+    def invalidate(self, path=None):
+        """使指定文件（或全部）的贴图失效"""
+        with self._lock:
+            for key in [k for k in self._tiles if path is None or k[0] == path]:
+                self._bytes -= self._tile_bytes(self._tiles.pop(key)[1])
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._tiles),
+                "bytes": self._bytes
+            }
+
+    def _store(self, key, signature, tile):
+        tile_bytes = self._tile_bytes(tile)
+        if tile_bytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._tiles.pop(key, None)
+            if old is not None:
+                self._bytes -= self._tile_bytes(old[1])
+            self._tiles[key] = (signature, tile)
+            self._bytes += tile_bytes
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._tiles.popitem(last=False)
+                self._bytes -= self._tile_bytes(evicted)
+
+    @staticmethod
+    def _tile_bytes(tile):
+        return tile.width * tile.height * len(tile.getbands())
+
+# ------------------------------------------------------------------------------
+# 渲染线程池 / 进程池
+# ------------------------------------------------------------------------------
+class RenderBusyError(Exception):
+    """渲染队列已满，或同一群 / 用户同时进行的渲染过多"""
+
+class RenderPool:
+    """插件专用的渲染执行器：限制排队深度与每个群 / 用户同时进行的渲染数，
+    饱和时立即拒绝而不是继续堆积大画布，并记录排队等待与渲染耗时。
+    backend 为 process 时使用进程池绕开 GIL，子进程崩溃后自动重建"""
+
+    BACKENDS = ("thread", "process")
+
+    def __init__(self, max_workers=2, max_queue=8, per_group=4, per_user=2, backend="thread", worker_options=None):
+        if backend not in self.BACKENDS:
+            logger.warning(f"未知的渲染后端: {backend}，使用 thread")
+            backend = "thread"
+        self.backend = backend
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.per_group = per_group
+        self.per_user = per_user
+        self._worker_options = worker_options or {}
+        self._executor = self._create_executor()
+        self._in_flight = 0
+        self._by_group = Counter()
+        self._by_user = Counter()
+        self._metrics = {
+            "completed": 0,
+            "failed": 0,
+            "rejected": 0,
+            "restarts": 0,
+            "wait_total": 0.0,
+            "wait_max": 0.0,
+            "render_total": 0.0,
+            "render_max": 0.0
+        }
+
+    async def run(self, func, *args, group=None, user=None, **kwargs):
+        """在渲染线程 / 子进程中执行 func，饱和时抛出 RenderBusyError；
+        进程后端下 func 与参数需可被 pickle"""
+        self._admit(group, user)
+        loop = asyncio.get_running_loop()
+        submitted_at = time.time()
+        executor = self._executor
+        try:
+            future = executor.submit(_timed_call, func, args, kwargs)
+        except BrokenProcessPool:
+            executor = self._restart(executor)
+            try:
+                future = executor.submit(_timed_call, func, args, kwargs)
+            except BaseException:
+                self._release(group, user)
+                raise
+        except BaseException:
+            self._release(group, user)
+            raise
+        # 以任务实际结束为准释放名额，调用方被取消时不会提前放行新任务
+        future.add_done_callback(
+            lambda f: loop.call_soon_threadsafe(self._finish, group, user, submitted_at, f)
+        )
+        try:
+            result, _, _ = await asyncio.wrap_future(future)
+        except BrokenProcessPool:
+            self._restart(executor)
+            raise
+        return result
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        metrics = dict(self._metrics)
+        done = metrics["completed"]
+        metrics["wait_avg"] = metrics["wait_total"] / done if done else 0.0
+        metrics["render_avg"] = metrics["render_total"] / done if done else 0.0
+        metrics["in_flight"] = self._in_flight
+        metrics["backend"] = self.backend
+        return {k: round(v, 4) if isinstance(v, float) else v for k, v in metrics.items()}
+
+    def _create_executor(self):
+        if self.backend == "process":
+            # spawn 避免在已有线程的进程中 fork
+            return ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_render_worker_init,
+                initargs=(self._worker_options,)
+            )
+        return ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="qqbox-render")
+
+    def _restart(self, broken):
+        """子进程异常退出后进程池不可再用，重建一次（并发失败的任务共享同一次重建）"""
+        if self._executor is broken:
+            logger.warning("渲染子进程异常退出，正在重建进程池")
+            broken.shutdown(wait=False, cancel_futures=True)
+            self._executor = self._create_executor()
+            self._metrics["restarts"] += 1
+        return self._executor
+
+    def _admit(self, group, user):
+        if self._in_flight >= self.max_workers + self.max_queue:
+            self._metrics["rejected"] += 1
+            raise RenderBusyError("渲染队列已满")
+        if group is not None and self.per_group and self._by_group[group] >= self.per_group:
+            self._metrics["rejected"] += 1
+            raise RenderBusyError(f"群 {group} 同时进行的渲染过多")
+        if user is not None and self.per_user and self._by_user[user] >= self.per_user:
+            self._metrics["rejected"] += 1
+            raise RenderBusyError(f"用户 {user} 同时进行的渲染过多")
+        self._in_flight += 1
+        if group is not None:
+            self._by_group[group] += 1
+        if user is not None:
+            self._by_user[user] += 1
+
+    def _release(self, group, user):
+        self._in_flight -= 1
+        for counter, key in ((self._by_group, group), (self._by_user, user)):
+            if key is not None:
+                counter[key] -= 1
+                if counter[key] <= 0:
+                    del counter[key]
+
+    def _finish(self, group, user, submitted_at, future):
+        self._release(group, user)
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            self._metrics["failed"] += 1
+            return
+        _, started, render = future.result()
+        wait = max(0.0, started - submitted_at)
+        self._metrics["completed"] += 1
+        self._metrics["wait_total"] += wait
+        self._metrics["wait_max"] = max(self._metrics["wait_max"], wait)
+        self._metrics["render_total"] += render
+        self._metrics["render_max"] = max(self._metrics["render_max"], render)
+
+def _timed_call(func, args, kwargs):
+    """执行渲染任务并附带开始时间与耗时（墙钟时间，可跨进程比较）"""
+    started = time.time()
+    begin = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, started, time.perf_counter() - begin
+
+# 渲染子进程内的气泡生成器，由 _render_worker_init 创建
+_worker_generator = None
+
+def _render_worker_init(options):
+    """渲染子进程初始化：创建生成器并同步加载一次字体"""
+    global _worker_generator
+    _worker_generator = ChatBubbleGenerator(**options)
+    _worker_generator.is_load_fonts = _worker_generator.load_fonts_sync()
+
+def _render_worker_task(spec):
+    """在渲染子进程中按渲染描述生成图片，返回编码后的字节"""
+    if _worker_generator is None or not _worker_generator.is_load_fonts:
+        raise RuntimeError("渲染子进程字体未加载")
+    return _worker_generator.render_spec(spec)
+
+# ------------------------------------------------------------------------------
+# 渲染结果缓存
+# ------------------------------------------------------------------------------
+class RenderResultCache:
+    """按内容寻址的渲染结果缓存：内存LRU（字节上限）+ 可选磁盘层（TTL淘汰）"""
+
+    SWEEP_INTERVAL = 256
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, disk_dir=None, disk_ttl=86400):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_ttl = disk_ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._puts = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(**parts):
+        """由渲染输入计算缓存键"""
+        payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def get(self, key):
+        """查询缓存，未命中返回 None"""
+        data = self._entries.get(key)
+        if data is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+        if self.disk_dir:
+            data = await asyncio.to_thread(self._read_disk, key)
+            if data is not None:
+                self.disk_hits += 1
+                self._remember(key, data)
+                return data
+
+        self.misses += 1
+        return None
+
+    async def put(self, key, data):
+        """写入缓存"""
+        self._remember(key, data)
+        if self.disk_dir:
+            self._puts += 1
+            try:
+                await asyncio.to_thread(self._write_disk, key, data)
+                if self._puts % self.SWEEP_INTERVAL == 0:
+                    await asyncio.to_thread(self._sweep_disk)
+            except OSError as e:
+                logger.warning(f"写入渲染缓存失败: {e}")
+
+    async def sweep(self):
+        """清理磁盘层中已过期的文件"""
+        if not self.disk_dir:
+            return
+        try:
+            removed = await asyncio.to_thread(self._sweep_disk)
+            if removed:
+                logger.info(f"已清理过期渲染缓存 {removed} 个")
+        except OSError as e:
+            logger.warning(f"清理渲染缓存失败: {e}")
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "bytes": self._bytes
+        }
+
+    def _remember(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old)
+        self._entries[key] = data
+        self._bytes += len(data)
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f"{key}.bin")
+
+    def _read_disk(self, key):
+        path = self._disk_path(key)
+        try:
+            if time.time() - os.stat(path).st_mtime > self.disk_ttl:
+                os.unlink(path)
+                return None
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write_disk(self, key, data):
+        write_file_atomic(self._disk_path(key), data)
+
+    def _sweep_disk(self):
+        if not os.path.isdir(self.disk_dir):
+            return 0
+        removed = 0
+        deadline = time.time() - self.disk_ttl
+        for root, _, files in os.walk(self.disk_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    if os.stat(path).st_mtime < deadline:
+                        os.unlink(path)
+                        removed += 1
+                except OSError:
+                    continue
+        return removed
+
+# ------------------------------------------------------------------------------
+# 字形宽度缓存
+# ------------------------------------------------------------------------------
+class GlyphAdvanceCache:
+    """按字体缓存单字宽度与字偶距，跨多次渲染共享"""
+
+    def __init__(self, max_pairs=65536):
+        self.max_pairs = max_pairs
+        self._fonts = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def for_font(self, font, draw):
+        """获取指定字体的宽度表"""
+        with self._lock:
+            metrics = self._fonts.get(font)
+            if metrics is None:
+                metrics = _FontMetrics(font, draw, self.max_pairs)
+                self._fonts[font] = metrics
+            return metrics
+
+    def clear(self):
+        with self._lock:
+            self._fonts.clear()
+
+class _FontMetrics:
+    """单个字体的字宽 / 字偶距表"""
+
+    def __init__(self, font, draw, max_pairs):
+        # 弱引用：GlyphAdvanceCache 以字体为弱键，值若强引用字体则条目永远不会被回收
+        self._font = weakref.ref(font)
+        self.draw = draw
+        self.max_pairs = max_pairs
+        self._advances = {}
+        self._kernings = {}
+        # basic 布局下行宽等于字宽与字偶距之和，可直接累加；
+        # raqm 布局可能存在连字等整形，留出一个字号的余量交给精确测量
+        if getattr(font, "layout_engine", None) == ImageFont.Layout.BASIC:
+            self.slack = 0
+        else:
+            self.slack = getattr(font, "size", 0)
+
+    def advance(self, char):
+        """单字宽度，无法渲染时返回 None"""
+        try:
+            return self._advances[char]
+        except KeyError:
+            pass
+        try:
+            width = self.draw.textlength(char, font=self._font())
+        except Exception:
+            width = None
+        self._advances[char] = width
+        return width
+
+    def kerning(self, left, right):
+        """两个相邻字符之间的字偶距"""
+        pair = left + right
+        try:
+            return self._kernings[pair]
+        except KeyError:
+            pass
+        try:
+            kern = self.draw.textlength(pair, font=self._font()) - self.advance(left) - self.advance(right)
+        except Exception:
+            kern = 0
+        if len(self._kernings) >= self.max_pairs:
+            self._kernings.clear()
+        self._kernings[pair] = kern
+        return kern
+
+# ------------------------------------------------------------------------------
+# 字体回退链
+# ------------------------------------------------------------------------------
+class FontFallbackChain:
+    """按各字体 cmap 覆盖的码位为每个字符选择字体，并把文本切分为字体段（run）
+
+    coverages 与字体顺序一致，为码位集合；None 表示覆盖情况未知（视为全部覆盖）。
+    所有字体都不包含的字符使用第一个字体
+    """
+
+    def __init__(self, coverages):
+        self.coverages = list(coverages)
+        self._resolved = {}
+
+    def __len__(self):
+        return len(self.coverages)
+
+    def resolve(self, char):
+        """字符所用字体在链中的序号"""
+        index = self._resolved.get(char)
+        if index is None:
+            index = 0
+            codepoint = ord(char)
+            for i, coverage in enumerate(self.coverages):
+                if coverage is None or codepoint in coverage:
+                    index = i
+                    break
+            self._resolved[char] = index
+        return index
+
+    def runs(self, text):
+        """切分为 [(字体序号, 文本段)]，相邻的同字体字符合并为一段"""
+        if len(self.coverages) <= 1 or not text:
+            return [(0, text)]
+        runs = []
+        start = 0
+        current = self.resolve(text[0])
+        for i in range(1, len(text)):
+            index = self.resolve(text[i])
+            if index != current:
+                runs.append((current, text[start:i]))
+                start = i
+                current = index
+        runs.append((current, text[start:]))
+        return runs
+
+def read_cmap_coverage(path, font_index=0):
+    """读取字体 cmap 表覆盖的 Unicode 码位（支持 TTF / OTF / TTC，cmap 格式 4 与 12）"""
+    with open(path, "rb") as f:
+        def read(offset, size):
+            f.seek(offset)
+            chunk = f.read(size)
+            if len(chunk) < size:
+                raise ValueError("字体文件不完整")
+            return chunk
+
+        # TTC 字体集合先定位到指定字体的表目录
+        offset = 0
+        if read(0, 4) == b"ttcf":
+            num_fonts = struct.unpack(">I", read(8, 4))[0]
+            if font_index >= num_fonts:
+                raise ValueError(f"字体集合中只有 {num_fonts} 个字体")
+            offset = struct.unpack(">I", read(12 + 4 * font_index, 4))[0]
+
+        num_tables = struct.unpack(">H", read(offset + 4, 2))[0]
+        records = read(offset + 12, 16 * num_tables)
+        for i in range(num_tables):
+            tag, _, table_offset, length = struct.unpack_from(">4sIII", records, 16 * i)
+            if tag == b"cmap":
+                return frozenset(_parse_cmap(read(table_offset, length)))
+    raise ValueError("字体缺少 cmap 表")
+
+def _parse_cmap(cmap):
+    """解析 cmap 表中的 Unicode 子表，优先使用覆盖完整码位的格式 12"""
+    subtables = {}
+    count = struct.unpack_from(">H", cmap, 2)[0]
+    for i in range(count):
+        platform, encoding, offset = struct.unpack_from(">HHI", cmap, 4 + 8 * i)
+        # 只使用 Unicode 平台与 Windows Unicode BMP / 全码位编码
+        if platform == 0 or (platform == 3 and encoding in (1, 10)):
+            subtables.setdefault(struct.unpack_from(">H", cmap, offset)[0], offset)
+
+    coverage = set()
+    if 12 in subtables:
+        offset = subtables[12]
+        num_groups = struct.unpack_from(">I", cmap, offset + 12)[0]
+        for i in range(num_groups):
+            start, end, glyph = struct.unpack_from(">III", cmap, offset + 16 + 12 * i)
+            # 映射到 0 号字形（.notdef）的码位不算覆盖
+            coverage.update(range(start + (glyph == 0), end + 1))
+    elif 4 in subtables:
+        offset = subtables[4]
+        seg_count = struct.unpack_from(">H", cmap, offset + 6)[0] // 2
+        ends = struct.unpack_from(f">{seg_count}H", cmap, offset + 14)
+        starts_at = offset + 16 + 2 * seg_count
+        starts = struct.unpack_from(f">{seg_count}H", cmap, starts_at)
+        deltas = struct.unpack_from(f">{seg_count}H", cmap, starts_at + 2 * seg_count)
+        range_offsets_at = starts_at + 4 * seg_count
+        range_offsets = struct.unpack_from(f">{seg_count}H", cmap, range_offsets_at)
+        for i, (start, end, delta, range_offset) in enumerate(zip(starts, ends, deltas, range_offsets)):
+            if start == 0xFFFF:
+                continue
+            if range_offset == 0:
+                coverage.update(range(start, end + 1))
+                unmapped = (-delta) & 0xFFFF
+                if start <= unmapped <= end:
+                    coverage.discard(unmapped)
+                continue
+            # 字形号从 glyphIdArray 中读取
+            base = range_offsets_at + 2 * i + range_offset
+            glyphs = struct.unpack_from(f">{end - start + 1}H", cmap, base)
+            for codepoint, glyph in zip(range(start, end + 1), glyphs):
+                if glyph and (glyph + delta) & 0xFFFF:
+                    coverage.add(codepoint)
+    else:
+        raise ValueError("字体没有可用的 Unicode cmap 子表")
+    return coverage
+
+# ------------------------------------------------------------------------------
+# 布局模型（不可变，可作为缓存键）
+# ------------------------------------------------------------------------------
+class BubbleLayout(namedtuple("BubbleLayout", "kind scale width height lines image_box")):
+    """聊天气泡布局，坐标均为 scale 倍超采样画布上的值
+
+    kind       text / image / text_image
+    lines      ((x, y, 文本), ...)
+    image_box  图片在画布上的 (x, y, 宽, 高)，没有图片时为 None
+    """
+    __slots__ = ()
+
+    @property
+    def size(self):
+        """缩回1x后的尺寸"""
+        return self.width // self.scale, self.height // self.scale
+
+class TitleLayout(namedtuple("TitleLayout", "text color scale width height text_position")):
+    """头衔气泡布局，坐标为 scale 倍超采样画布上的值"""
+    __slots__ = ()
+
+    @property
+    def size(self):
+        return self.width // self.scale, self.height // self.scale
+
+class TitleSprite(namedtuple("TitleSprite", "image width")):
+    """缓存的头衔徽章：已缩回1x、可直接粘贴的 RGBA 图片，以及昵称需要右移的宽度"""
+    __slots__ = ()
+
+class MessageLayout(namedtuple(
+        "MessageLayout",
+        "width height bubble bubble_position avatar_position nickname nickname_position title title_position"
+)):
+    """整条消息的布局（1x坐标），title 为 None 时表示没有头衔"""
+    __slots__ = ()
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+class ConversationLayout(namedtuple("ConversationLayout", "width height messages")):
+    """聊天记录布局，messages 为 ((MessageLayout, 纵向偏移), ...)"""
+    __slots__ = ()
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+class ConversationTooLargeError(ValueError):
+    """聊天记录画布超过像素上限"""
 
-        await self._save_qq_data()
+# ------------------------------------------------------------------------------
+# 流式 PNG 编码
+# ------------------------------------------------------------------------------
+class PngStreamWriter:
+    """按条带写入 RGBA 像素的 PNG 编码器（Up 滤波 + zlib），整张图片不需要常驻内存"""
+
+    SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+    def __init__(self, width, height, compress_level=6):
+        self.width = width
+        self.height = height
+        self.rows = 0
+        self._output = BytesIO()
+        self._compressor = zlib.compressobj(compress_level)
+        self._previous = None  # 上一条带的最后一行，作为下一条带首行的 Up 参考
+
+        self._output.write(self.SIGNATURE)
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+
+    def _chunk(self, kind, data):
+        self._output.write(struct.pack(">I", len(data)))
+        self._output.write(kind)
+        self._output.write(data)
+        self._output.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+    def write(self, band):
+        """写入一段宽度为 width 的 RGBA 条带"""
+        width, height = band.size
+        if width != self.width or self.rows + height > self.height:
+            raise ValueError(f"条带尺寸不匹配: {band.size}，已写入 {self.rows}/{self.height} 行")
+
+        # Up 滤波：每行减去上一行（逐字节取模），参考行整体下移一行后一次相减
+        reference = Image.new("RGBA", band.size, (0, 0, 0, 0))
+        if self._previous is not None:
+            reference.paste(self._previous, (0, 0))
+        if height > 1:
+            reference.paste(band.crop((0, 0, width, height - 1)), (0, 1))
+        filtered = ImageChops.subtract_modulo(band, reference).tobytes()
+
+        stride = width * 4
+        data = b"".join(
+            b"\x02" + filtered[offset:offset + stride]
+            for offset in range(0, len(filtered), stride)
+        )
+        self._write_idat(self._compressor.compress(data))
+        self._previous = band.crop((0, height - 1, width, height))
+        self.rows += height
+
+    def _write_idat(self, data):
+        if data:
+            self._chunk(b"IDAT", data)
+
+    def finish(self):
+        """结束编码并返回 PNG 字节流"""
+        if self.rows != self.height:
+            raise ValueError(f"PNG 行数不足: {self.rows}/{self.height}")
+        self._write_idat(self._compressor.flush())
+        self._chunk(b"IEND", b"")
+        self._output.seek(0)
+        return self._output
 
 # ------------------------------------------------------------------------------
 # 高 DPI 超清聊天气泡生成器
 # ------------------------------------------------------------------------------
 class ChatBubbleGenerator:
+    # 渲染质量预设：
+    #   scale        常规元素的超采样倍率
+    #   large_scale  画布超过 large_canvas_pixels 时改用的倍率
+    #   downsample   缩回1x的方式，lanczos 或整数倍盒式滤波 reduce
+    #   text_scale   为 None 时整个气泡按 scale 超采样绘制；否则气泡背景由预渲染的
+    #                九宫格模板在1x拼接，文字按该倍率单独绘制
+    QUALITY_PRESETS = {
+        "high": {"scale": 4, "large_scale": 4, "downsample": "lanczos", "text_scale": None},
+        "balanced": {"scale": 4, "large_scale": 2, "downsample": "lanczos", "text_scale": 2},
+        "fast": {"scale": 2, "large_scale": 2, "downsample": "reduce", "text_scale": 1}
+    }
+
+    # 九宫格模板中圆角区域之外额外保留的像素，避免缩放滤波把圆角混入边条
+    TEMPLATE_MARGIN = 4
+
+    # 气泡描边
+    BUBBLE_OUTLINE = (230, 230, 230, 255)
+
+    # 输出编码：格式 -> 文件扩展名
+    OUTPUT_FORMATS = {
+        "png": ".png",          # 与旧版本一致：PNG + optimize
+        "png_fast": ".png",     # 仅 zlib 压缩，跳过 optimize
+        "png_palette": ".png",  # 量化为 256 色调色板 PNG，适合纯色为主的气泡
+        "webp": ".webp",
+        "jpeg": ".jpg"
+    }
+
+    # 调色板量化时颜色数超过该值视为照片类图片，改用 png_fast
+    PALETTE_MAX_SOURCE_COLORS = 8192
+
+    # 参与样式摘要的布局 / 颜色参数
+    _STYLE_ATTRS = (
+        "SCALE", "bubble_padding", "title_padding_x", "title_padding_y",
+        "title_padding_y_offset", "title_bubble_offset", "title_bubble_name_offset",
+        "margin", "max_width", "corner_radius", "avatar_size", "bubble_position",
+        "avatar_position", "bubble_bg_color", "text_color", "render_quality",
+        "large_canvas_pixels", "text_scale", "output_format", "output_quality",
+        "png_compress_level"
+    )
+
     def __init__(
             self,
             bubble_font_path,
@@ -378,10 +2194,57 @@ class ChatBubbleGenerator:
             max_width=640,
             bubble_position=(120, 60),
             avatar_position=(23, 10),
-            background_color="#F0F0F2"
+            background_color="#F0F0F2",
+            avatar_cache_bytes=16 * 1024 * 1024,
+            avatar_mipmap=False,
+            render_quality="high",
+            large_canvas_pixels=8_000_000,
+            max_image_bytes=20 * 1024 * 1024,
+            max_image_pixels=40_000_000,
+            output_format="png",
+            output_quality=90,
+            png_compress_level=1,
+            max_conversation_pixels=40_000_000,
+            band_height=256,
+            band_canvas_pixels=16_000_000,
+            fallback_font_paths=()
     ):
         # 常量配置
-        self.SCALE = 4  # supersampling 倍率
+        self.SCALE = 4  # supersampling 倍率（字体与头衔尺寸参数的基准）
+
+        # 渲染质量
+        if render_quality not in self.QUALITY_PRESETS:
+            logger.warning(f"未知的渲染质量: {render_quality}，使用 high")
+            render_quality = "high"
+        preset = self.QUALITY_PRESETS[render_quality]
+        self.render_quality = render_quality
+        self.render_scale = preset["scale"]
+        self.large_render_scale = preset["large_scale"]
+        self.downsample_filter = preset["downsample"]
+        self.text_scale = preset["text_scale"]
+        self.large_canvas_pixels = large_canvas_pixels
+
+        # 图片输入限制
+        self.max_image_bytes = max_image_bytes
+        self.max_image_pixels = max_image_pixels
+
+        # 聊天记录画布上限
+        self.max_conversation_pixels = max_conversation_pixels
+
+        # 分段绘制：超采样画布超过 band_canvas_pixels 时按 band_height 行（1x）一段绘制
+        self.band_height = max(16, band_height)
+        self.band_canvas_pixels = band_canvas_pixels
+
+        # 输出编码
+        if output_format not in self.OUTPUT_FORMATS:
+            logger.warning(f"未知的输出格式: {output_format}，使用 png")
+            output_format = "png"
+        self.output_format = output_format
+        self.output_extension = self.OUTPUT_FORMATS[output_format]
+        self.output_quality = output_quality
+        self.png_compress_level = png_compress_level
+        self._encode_stats = {}
+        self._encode_stats_lock = threading.Lock()
 
         # 字体配置
         self._font_configs = {
@@ -389,6 +2252,8 @@ class ChatBubbleGenerator:
             'nickname': (nickname_font_path, nickname_font_size),
             'title': (title_font_path, title_font_size)
         }
+        # 回退字体（按顺序），主字体 cmap 中没有的字符依次在其中查找
+        self.fallback_font_paths = tuple(path for path in (fallback_font_paths or ()) if path)
 
         # 颜色配置
         self.color_map = {
@@ -401,6 +2266,26 @@ class ChatBubbleGenerator:
         # 缓存
         self._temp_canvas = None
         self._temp_draw = None
+        self._glyph_cache = GlyphAdvanceCache()
+        self._scaled_fonts = {}
+        self._scaled_fonts_lock = threading.Lock()
+        self._font_coverages = {}
+        self._font_chains = {}
+        self._fallback_paths = ()
+        self._run_lengths = OrderedDict()
+        self._run_lengths_lock = threading.Lock()
+        self.max_run_lengths = 8192
+        self._line_heights = {}
+        self._templates = {}
+        self._layouts = OrderedDict()
+        self._layouts_lock = threading.Lock()
+        self.max_layouts = 512
+        self._title_sprites = OrderedDict()
+        self._title_sprites_lock = threading.Lock()
+        self.max_title_sprites = 256
+        self._title_sprite_stats = {"hits": 0, "misses": 0}
+        self.avatar_tiles = AvatarTileCache(avatar_cache_bytes)
+        self._style_fingerprint = None
 
         # 初始化字体
         # self.is_load_fonts = self._load_fonts()
@@ -424,6 +2309,7 @@ class ChatBubbleGenerator:
         self.bubble_bg_color = bubble_bg_color
         self.text_color = text_color
         self.avatar_image_path = avatar_image_path
+        self.avatar_mipmap = avatar_mipmap
 
         # 背景颜色处理
         if background_color.startswith("#"):
@@ -438,92 +2324,277 @@ class ChatBubbleGenerator:
     # ------------------------------------------------------------------------------
     async def load_fonts(self):
         """异步加载字体"""
+        return await asyncio.to_thread(self.load_fonts_sync)
+
+    def load_fonts_sync(self):
+        """同步加载字体（渲染子进程初始化时直接调用）"""
+        self._style_fingerprint = None
+        self._line_heights = {}
+        with self._layouts_lock:
+            self._layouts.clear()
+        self.invalidate_title_sprites()
         try:
             # 气泡字体（高DPI）
             b_path, b_size = self._font_configs['bubble']
-            self.bubble_font = await self._async_safe_load_font(
+            self.bubble_font = self._safe_load_font(
                 b_path, b_size * self.SCALE, "气泡"
             )
             # 昵称字体（正常DPI）
             n_path, n_size = self._font_configs['nickname']
-            self.nickname_font = await self._async_safe_load_font(
+            self.nickname_font = self._safe_load_font(
                 n_path, n_size, "昵称"
             )
             # 头衔字体（双DPI版本）
             t_path, t_size = self._font_configs['title']
-            self.title_SCALE_font = await self._async_safe_load_font(
+            self.title_SCALE_font = self._safe_load_font(
                 t_path, t_size * self.SCALE, "头衔高DPI"
             )
-            self.title_font = await self._async_safe_load_font(
+            self.title_font = self._safe_load_font(
                 t_path, t_size, "头衔"
             )
+
+            # 按倍率索引的字体，预加载当前质量预设会用到的倍率
+            self._scaled_fonts = {
+                ('bubble', self.SCALE): self.bubble_font,
+                ('title', self.SCALE): self.title_SCALE_font,
+                ('title', 1): self.title_font,
+                ('nickname', 1): self.nickname_font
+            }
+            with self._run_lengths_lock:
+                self._run_lengths.clear()
+            self._build_font_chains()
+            for scale in {self.render_scale, self.large_render_scale}:
+                self._scaled_font('bubble', scale)
+                self._scaled_font('title', scale)
+            if self.text_scale is not None:
+                self._scaled_font('bubble', self.text_scale)
+                self._scaled_font('title', self.text_scale)
+                self._warm_templates()
             return True
         except Exception as e:
             logger.error(f"字体加载失败: {e}")
             return False
 
-    async def _async_safe_load_font(self, path, size, name):
+    def _safe_load_font(self, path, size, name):
         if path and os.path.exists(path):
-            return await asyncio.to_thread(ImageFont.truetype, path, size)
+            return ImageFont.truetype(path, size)
         else:
             logger.warning(f"字体文件不存在: {path}")
             raise FileNotFoundError(f"字体文件不存在: {name} ({path})")
 
-    # ------------------------------------------------------------------------------
-    # 工具方法
-    # ------------------------------------------------------------------------------
-    def _get_temp_draw(self):
-        """获取临时绘图上下文（延迟初始化）"""
+    def _font_coverage(self, path):
+        """字体 cmap 覆盖的码位集合（每个字体文件只读取一次），无法读取时返回 None"""
+        if path not in self._font_coverages:
+            coverage = None
+            try:
+                coverage = read_cmap_coverage(path)
+            except (OSError, ValueError, struct.error) as e:
+                logger.warning(f"读取字体字符表失败: {path}, 错误: {e}")
+            self._font_coverages[path] = coverage
+        return self._font_coverages[path]
+
+    def _build_font_chains(self):
+        """为每类字体建立回退链；未配置回退字体时不读取 cmap"""
+        coverages = []
+        paths = []
+        for path in self.fallback_font_paths:
+            if not os.path.exists(path):
+                logger.warning(f"回退字体不存在: {path}")
+                continue
+            coverage = self._font_coverage(path)
+            if coverage is not None:
+                paths.append(path)
+                coverages.append(coverage)
+        self._fallback_paths = tuple(paths)
+
+        self._font_chains = {}
+        for kind, (path, _) in self._font_configs.items():
+            if paths:
+                # 主字体字符表无法读取时视为全部覆盖，不使用回退字体
+                self._font_chains[kind] = FontFallbackChain([self._font_coverage(path)] + coverages)
+            else:
+                self._font_chains[kind] = FontFallbackChain([None])
+
+    def _chain_font(self, kind, scale, index):
+        """回退链中第 index 个字体（0 为主字体）；回退字体无法按该字号加载时使用主字体"""
+        if index == 0:
+            return self._scaled_font(kind, scale)
+        key = (kind, scale, index)
+        font = self._scaled_fonts.get(key)
+        if font is None:
+            path = self._fallback_paths[index - 1]
+            try:
+                font = ImageFont.truetype(path, self._font_configs[kind][1] * scale)
+            except OSError as e:
+                logger.warning(f"回退字体无法按字号 {self._font_configs[kind][1] * scale} 加载: {path}, 错误: {e}")
+                font = self._scaled_font(kind, scale)
+            with self._scaled_fonts_lock:
+                font = self._scaled_fonts.setdefault(key, font)
+        return font
+
+    def _scaled_font(self, kind, scale):
+        """获取指定倍率的字体（按需加载并缓存）"""
+        key = (kind, scale)
+        font = self._scaled_fonts.get(key)
+        if font is None:
+            with self._scaled_fonts_lock:
+                font = self._scaled_fonts.get(key)
+                if font is None:
+                    path, size = self._font_configs[kind]
+                    font = ImageFont.truetype(path, size * scale)
+                    self._scaled_fonts[key] = font
+        return font
+
+    # ------------------------------------------------------------------------------
+    # 工具方法
+    # ------------------------------------------------------------------------------
+    def style_fingerprint(self):
+        """影响渲染结果的字体与样式参数摘要，用作结果缓存键的一部分"""
+        if self._style_fingerprint is None:
+            def font_version(path):
+                try:
+                    stat = os.stat(path)
+                    return stat.st_mtime_ns, stat.st_size
+                except (OSError, TypeError):
+                    return None
+
+            fonts = {}
+            for kind, (path, size) in self._font_configs.items():
+                fonts[kind] = (path, size, font_version(path))
+            style = {
+                "fonts": fonts,
+                "fallback_fonts": [(path, font_version(path)) for path in self.fallback_font_paths],
+                "color_map": self.color_map,
+                "background_color": self.background_color,
+                "avatar_mipmap": self.avatar_mipmap
+            }
+            for name in self._STYLE_ATTRS:
+                style[name] = getattr(self, name)
+            payload = json.dumps(style, sort_keys=True, default=str)
+            self._style_fingerprint = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+        return self._style_fingerprint
+
+    def _get_temp_draw(self):
+        """获取临时绘图上下文（延迟初始化）"""
         if self._temp_canvas is None:
             self._temp_canvas = Image.new("RGBA", (10, 10))
             self._temp_draw = ImageDraw.Draw(self._temp_canvas)
         return self._temp_draw
 
-    def _wrap_text(self, text, font):
-        """文本自动换行"""
+    def _text_runs(self, text, kind, scale):
+        """按回退链把文本切分为 [(字体, 文本段)]"""
+        chain = self._font_chains.get(kind)
+        if chain is None or len(chain) <= 1:
+            return [(self._scaled_font(kind, scale), text)]
+        return [(self._chain_font(kind, scale, index), run) for index, run in chain.runs(text)]
+
+    def _run_length(self, font, run):
+        """单个字体段的宽度（LRU 缓存）"""
+        key = (font, run)
+        with self._run_lengths_lock:
+            length = self._run_lengths.get(key)
+            if length is not None:
+                self._run_lengths.move_to_end(key)
+                return length
+        length = self._get_temp_draw().textlength(run, font=font)
+        with self._run_lengths_lock:
+            self._run_lengths[key] = length
+            while len(self._run_lengths) > self.max_run_lengths:
+                self._run_lengths.popitem(last=False)
+        return length
+
+    def _text_length(self, text, kind, scale):
+        """按字体段测量文本宽度"""
+        return sum(self._run_length(font, run) for font, run in self._text_runs(text, kind, scale))
+
+    def _draw_text(self, draw, position, text, kind, scale, fill):
+        """按字体段依次绘制文本，多字体时各段按主字体基线对齐"""
+        runs = self._text_runs(text, kind, scale)
+        if len(runs) == 1:
+            draw.text(position, text, fill=fill, font=runs[0][0])
+            return
+        x, y = position
+        baseline = y + self._scaled_font(kind, scale).getmetrics()[0]
+        for font, run in runs:
+            draw.text((x, baseline), run, fill=fill, font=font, anchor="ls")
+            x += self._run_length(font, run)
+
+    def _wrap_text(self, text, kind='bubble', scale=None):
+        """文本自动换行（逐字累加缓存宽度，仅在候选断点处精确测量）"""
+        if scale is None:
+            scale = self.SCALE
         draw = self._get_temp_draw()
-        padding = self.bubble_padding * self.SCALE
-        max_width = self.max_width * self.SCALE - padding * 2
+        padding = self.bubble_padding * scale
+        max_width = self.max_width * scale - padding * 2
+
+        # 回退链中每个字体各自的字宽表，字符按 cmap 覆盖表 O(1) 选择字体
+        chain = self._font_chains.get(kind) or FontFallbackChain([None])
+        metrics = [
+            self._glyph_cache.for_font(self._chain_font(kind, scale, index), draw)
+            for index in range(len(chain))
+        ]
+        slack = max(glyphs.slack for glyphs in metrics)
 
         lines = []
-        current_line = ""
+        current_line = []
+        line_width = 0
+        previous_index = None
 
         for char in text:
             if char == "\n":
-                lines.append(current_line)
-                current_line = ""
+                lines.append("".join(current_line))
+                current_line = []
+                line_width = 0
                 continue
 
-            test_line = current_line + char
-            try:
-                line_width = draw.textlength(test_line, font=font)
-            except:
+            index = chain.resolve(char)
+            glyphs = metrics[index]
+            advance = glyphs.advance(char)
+            if advance is None:
                 # 处理无法渲染的字符
                 char = " "
-                test_line = current_line + char
-                line_width = draw.textlength(test_line, font=font)
+                index = chain.resolve(char)
+                glyphs = metrics[index]
+                advance = glyphs.advance(char)
+
+            # 估算宽度 = 当前行宽度 + 字偶距（仅同一字体内） + 字宽
+            estimate = line_width + advance
+            if current_line and index == previous_index:
+                estimate += glyphs.kerning(current_line[-1], char)
 
-            if line_width <= max_width:
-                current_line = test_line
+            if estimate <= max_width - slack:
+                fits = True
+            else:
+                # 接近行宽上限，精确测量整行以保证与逐字测量结果一致
+                estimate = self._text_length("".join(current_line) + char, kind, scale)
+                fits = estimate <= max_width
+
+            if fits:
+                current_line.append(char)
+                line_width = estimate
             else:
                 if current_line:  # 避免空行
-                    lines.append(current_line)
-                current_line = char
+                    lines.append("".join(current_line))
+                current_line = [char]
+                line_width = advance
+            previous_index = index
 
         if current_line:
-            lines.append(current_line)
+            lines.append("".join(current_line))
 
         return lines
 
-    def _create_rounded_mask(self, width, height):
+    def _create_rounded_mask(self, width, height, scale=None):
         """创建圆角遮罩"""
+        if scale is None:
+            scale = self.SCALE
         mask = Image.new("L", (width, height), 0)
         draw_mask = ImageDraw.Draw(mask)
 
         # 动态计算圆角半径
         min_side = min(width, height)
         dynamic_radius = int(min_side * 0.05)
-        final_radius = min(dynamic_radius, 50 * self.SCALE)
+        final_radius = min(dynamic_radius, 50 * scale)
 
         draw_mask.rounded_rectangle(
             (0, 0, width, height),
@@ -532,196 +2603,722 @@ class ChatBubbleGenerator:
         )
         return mask
 
-    def _resize_image_for_bubble(self, image, padding=None):
-        """调整图片大小以适应气泡"""
-        if padding is None:
-            padding = self.bubble_padding * self.SCALE
-
-        max_width = self.max_width * self.SCALE - padding * 2
-        orig_width, orig_height = image.size
+    def _fit_bubble_image(self, image_size, scale):
+        """图片适配气泡宽度后在 scale 倍画布上的尺寸"""
+        padding = self.bubble_padding * scale
+        max_width = self.max_width * scale - padding * 2
+        width, height = image_size
 
-        if orig_width <= max_width:
-            return image
+        if width <= max_width:
+            return width, height
 
         # 按比例缩放
-        ratio = max_width / orig_width
-        new_width = int(orig_width * ratio)
-        new_height = int(orig_height * ratio)
+        ratio = max_width / width
+        return int(width * ratio), int(height * ratio)
+
+    def _downsample(self, canvas, scale):
+        """将超采样画布缩回1x，整数倍时可使用 reduce 盒式滤波"""
+        if scale <= 1:
+            return canvas
+        width, height = canvas.size
+        size = (width // scale, height // scale)
+        if self.downsample_filter == "reduce":
+            if width % scale or height % scale:
+                canvas = canvas.crop((0, 0, size[0] * scale, size[1] * scale))
+            return canvas.reduce(scale)
+        return canvas.resize(size, Image.Resampling.LANCZOS)
+
+    def _line_height(self, scale):
+        """气泡文字行高（按倍率缓存）"""
+        line_height = self._line_heights.get(scale)
+        if line_height is None:
+            bbox = self._scaled_font('bubble', scale).getbbox("字")
+            line_height = bbox[3] - bbox[1] + 4 * scale
+            self._line_heights[scale] = line_height
+        return line_height
+
+    def _measure_text(self, text, scale):
+        """按指定倍率换行并计算文本区域尺寸"""
+        lines = self._wrap_text(text, 'bubble', scale) if text else []
+        line_height = self._line_height(scale)
 
-        return image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+        if lines:
+            text_width = max(self._text_length(line, 'bubble', scale) for line in lines)
+            text_height = line_height * len(lines)
+        else:
+            text_width = text_height = 0
+        return lines, line_height, text_width, text_height
+
+    def _pick_scale(self, canvas_pixels):
+        """根据基准倍率下的画布像素数选择超采样倍率"""
+        base = self.render_scale
+        if canvas_pixels > self.large_canvas_pixels and self.large_render_scale < base:
+            return self.large_render_scale
+        return base
 
     # ------------------------------------------------------------------------------
-    # 气泡创建方法
+    # 布局：只测量不绘制，结果不可变并按输入缓存
     # ------------------------------------------------------------------------------
-    def create_chat_bubble(self, text):
-        """创建纯文本聊天气泡"""
-        SCALE = self.SCALE
-        font = self.bubble_font
-        padding = self.bubble_padding * SCALE
+    def _cached_layout(self, key, build):
+        """按输入缓存布局，相同输入只测量一次"""
+        with self._layouts_lock:
+            layout = self._layouts.get(key)
+            if layout is not None:
+                self._layouts.move_to_end(key)
+                return layout
+        layout = build()
+        with self._layouts_lock:
+            self._layouts[key] = layout
+            self._layouts.move_to_end(key)
+            while len(self._layouts) > self.max_layouts:
+                self._layouts.popitem(last=False)
+        return layout
+
+    def layout_bubble(self, text, image_size=None):
+        """气泡布局；image_size 为 load_bubble_image 读取后的图片尺寸（按 self.SCALE 倍画布计）"""
+        return self._cached_layout(
+            ("bubble", text, image_size),
+            lambda: self._build_bubble_layout(text, image_size)
+        )
 
-        # 文本换行
-        lines = self._wrap_text(text, font)
-        if not lines:
-            lines = [""]
+    def _build_bubble_layout(self, text, image_size):
+        if image_size is None:
+            return self._build_text_layout(text or " ")
+        if not text:
+            return self._build_image_layout(image_size)
+        return self._build_text_image_layout(text, image_size)
+
+    def _build_text_layout(self, text):
+        """纯文本气泡布局"""
+
+        def measure(scale):
+            lines, line_height, text_width, text_height = self._measure_text(text, scale)
+            if not lines:
+                lines = [""]
+            padding = self.bubble_padding * scale
+            width = int(text_width + padding * 2)
+            height = int(text_height + padding * (2 + len(lines)))
+            return lines, line_height, padding, width, height
+
+        SCALE = self.render_scale
+        lines, line_height, padding, width, height = measure(SCALE)
+        scale = self._pick_scale(width * height)
+        if scale != SCALE:
+            SCALE = scale
+            lines, line_height, padding, width, height = measure(SCALE)
+
+        positioned = tuple(
+            (padding, padding + index * (line_height + padding), line)
+            for index, line in enumerate(lines)
+        )
+        return BubbleLayout("text", SCALE, width, height, positioned, None)
+
+    def _build_image_layout(self, image_size):
+        """纯图片气泡布局"""
+        SCALE = self.render_scale
+        # 图片以 self.SCALE 倍画布为基准适配，再换算到当前倍率，各质量预设的输出尺寸一致
+        width, height = self._fit_bubble_image(image_size, self.SCALE)
+        if SCALE != self.SCALE:
+            width, height = width * SCALE // self.SCALE, height * SCALE // self.SCALE
+        return BubbleLayout("image", SCALE, width, height, (), (0, 0, width, height))
+
+    def _build_text_image_layout(self, text, image_size):
+        """图文混合气泡布局"""
+        SCALE = self.render_scale
+        padding = self.bubble_padding * SCALE
 
-        # 计算尺寸
-        draw = self._get_temp_draw()
-        bbox = font.getbbox("字")
-        line_height = bbox[3] - bbox[1] + 4 * SCALE
+        # 图片尺寸与“按 self.SCALE 倍画布适配气泡宽度后缩回1x再放大”的结果一致
+        img_width, img_height = self._fit_bubble_image(image_size, self.SCALE)
+        img_width, img_height = img_width // self.SCALE * SCALE, img_height // self.SCALE * SCALE
 
-        text_width = max(draw.textlength(line, font=font) for line in lines)
-        text_height = line_height * len(lines)
+        lines, line_height, text_width, text_height = self._measure_text(text, SCALE)
 
-        width = int(text_width + padding * 2)
-        height = int(text_height + padding * (2 + len(lines)))
+        width = int(max(text_width, img_width) + padding * 2)
+        height = int(text_height + padding * (2 + len(lines)) + img_height + padding)
 
-        # 创建画布
-        canvas = Image.new("RGBA", (width, height), (0, 0, 0, 0))
-        draw_canvas = ImageDraw.Draw(canvas)
+        positioned = tuple(
+            (padding, padding + index * (line_height + padding), line)
+            for index, line in enumerate(lines)
+        )
+        img_x = (width - img_width) // 2
+        img_y = text_height + padding * (2 + len(lines) if lines else 1)
+        return BubbleLayout(
+            "text_image", SCALE, width, height, positioned,
+            (img_x, img_y, img_width, img_height)
+        )
 
-        # 绘制气泡背景
-        draw_canvas.rounded_rectangle(
-            (0, 0, width, height),
-            radius=self.corner_radius * SCALE,
-            fill=self.bubble_bg_color,
-            outline=(230, 230, 230, 255),
-            width=2 * SCALE
+    def layout_title(self, text, bg_color):
+        """头衔气泡布局"""
+        return self._cached_layout(
+            ("title", text, bg_color),
+            lambda: self._build_title_layout(text, bg_color)
         )
 
-        # 绘制文本
-        y = padding
-        for line in lines:
-            draw_canvas.text((padding, y), line, fill=self.text_color, font=font)
-            y += line_height + padding
+    def _build_title_layout(self, text, bg_color):
+        SCALE = self.render_scale
+        font = self._scaled_font('title', SCALE)
+        # 头衔内边距以 self.SCALE 倍画布为基准给出
+        factor = SCALE / self.SCALE
 
-        # 缩放到正常尺寸
-        return canvas.resize((width // SCALE, height // SCALE), Image.Resampling.LANCZOS)
+        # 测量文本
+        text_width = int(self._text_length(text, 'title', SCALE))
 
-    def create_chat_img_bubble(self, image):
-        """创建纯图片聊天气泡"""
-        SCALE = self.SCALE
+        # 计算字体高度
+        bbox = font.getbbox(text)
+        text_height = bbox[3] - bbox[1] + 4 * SCALE
 
-        # 加载图片
-        if isinstance(image, str):
-            img = Image.open(image)
-        else:
-            img = image
+        # 计算尺寸
+        width = int(text_width + self.title_padding_x * factor * 2)
+        height = int(text_height + self.title_padding_y * factor * 3)
+        text_position = (self.title_padding_x * factor, self.title_padding_y_offset * factor)
+        return TitleLayout(text, bg_color, SCALE, width, height, text_position)
+
+    def layout_message(self, text, image_size, nickname, title_info=None):
+        """整条消息的布局：气泡、头像、昵称与头衔的位置及画布尺寸"""
+        bubble = self.layout_bubble(text, image_size)
+        title = self.resolve_title(title_info)
+        return self._cached_layout(
+            ("message", bubble, nickname, title),
+            lambda: self._build_message_layout(bubble, nickname, title)
+        )
 
-        # 缩放图片
-        img = self._resize_image_for_bubble(img)
-        width, height = img.size
+    def resolve_title(self, title_info):
+        """头衔数据 -> (头衔内容, 背景色)，没有头衔时返回 None
 
-        # 创建圆角图片
-        canvas = Image.new("RGBA", (width, height), (0, 0, 0, 0))
-        mask = self._create_rounded_mask(width, height)
-        canvas.paste(img, (0, 0), mask)
+        只设置了备注名的用户（content 为 None）没有头衔；颜色缺失或无效时使用默认颜色
+        """
+        if not title_info or title_info.get("content") is None:
+            return None
+        try:
+            color = int(title_info.get("color") or 1)
+        except (TypeError, ValueError):
+            color = 1
+        return title_info["content"], self.color_map.get(color, self.color_map[1])
 
-        # 缩放到正常尺寸
-        if SCALE > 1:
-            canvas = canvas.resize(
-                (width // SCALE, height // SCALE),
-                Image.Resampling.LANCZOS
-            )
+    def _build_message_layout(self, bubble, nickname, title):
+        bubble_w, bubble_h = bubble.size
 
-        return canvas
+        # 测量文本宽度
+        nickname_width = self._text_length(nickname, 'nickname', 1) + self.bubble_padding
 
-    def create_chat_text_img_bubble(self, text, image):
-        """创建图文混合聊天气泡"""
-        SCALE = self.SCALE
-        font = self.bubble_font
-        padding = self.bubble_padding * SCALE
+        # 计算基础宽度
+        width_candidates = [
+            self.bubble_position[0] + bubble_w + self.margin,
+            self.avatar_position[0] + self.avatar_size[0] + self.margin,
+            self.bubble_position[0] + nickname_width
+        ]
 
-        # 处理图片部分
-        img_canvas = self.create_chat_img_bubble(image)
-        if SCALE > 1:
-            img_canvas = img_canvas.resize(
-                (img_canvas.width * SCALE, img_canvas.height * SCALE),
-                Image.Resampling.LANCZOS
+        # 如果有头衔，调整宽度并把昵称右移
+        title_layout = None
+        title_position = None
+        nickname_position = (self.bubble_position[0], self.avatar_position[1])
+        if title:
+            title_content, title_color = title
+            title_width = self._text_length(title_content, 'title', 1) + self.bubble_padding
+            width_candidates.append(
+                self.bubble_position[0] + nickname_width + title_width + self.title_bubble_name_offset
+            )
+            title_layout = self.layout_title(title_content, title_color)
+            title_position = (self.bubble_position[0], self.avatar_position[1] + self.title_bubble_offset)
+            nickname_position = (
+                self.bubble_position[0] + title_width + self.title_bubble_name_offset,
+                self.avatar_position[1]
             )
 
-        # 处理文本部分
-        lines = self._wrap_text(text, font) if text else []
+        # 计算高度
+        height_candidates = [
+            self.bubble_position[1] + bubble_h + self.margin,
+            self.avatar_position[1] + self.avatar_size[1] + self.margin
+        ]
 
-        # 计算尺寸
-        draw = self._get_temp_draw()
-        bbox = font.getbbox("字")
-        line_height = bbox[3] - bbox[1] + 4 * SCALE
+        return MessageLayout(
+            int(max(width_candidates)),
+            int(max(height_candidates)),
+            bubble,
+            self.bubble_position,
+            self.avatar_position,
+            nickname,
+            nickname_position,
+            title_layout,
+            title_position
+        )
 
-        if lines:
-            text_width = max(draw.textlength(line, font=font) for line in lines)
-            text_height = line_height * len(lines)
-        else:
-            text_width = text_height = 0
+    def layout_conversation(self, messages):
+        """聊天记录布局：逐条排版（每条消息的布局各自缓存）后自上而下拼接
 
-        width = int(max(text_width, img_canvas.width) + padding * 2)
-        height = int(text_height + padding * (2 + len(lines)) + img_canvas.height + padding)
+        messages 为 [(text, image_size, nickname, title_info), ...]
+        """
+        placed = []
+        y = 0
+        for message in messages:
+            layout = self.layout_message(*message)
+            placed.append((layout, y))
+            y += layout.height
+        width = max((layout.width for layout, _ in placed), default=0)
+        return ConversationLayout(width, y, tuple(placed))
 
-        # 创建最终画布
-        canvas = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    # ------------------------------------------------------------------------------
+    # 绘制：按布局栅格化
+    # ------------------------------------------------------------------------------
+    def render_bubble(self, layout, image=None):
+        """按气泡布局绘制并缩回1x"""
+        SCALE = layout.scale
+
+        if layout.kind == "image":
+            # 纯图片：圆角裁剪后直接缩回1x
+            _, _, width, height = layout.image_box
+            img = self.load_bubble_image(image, SCALE)
+            if img.size != (width, height):
+                img = img.resize((width, height), Image.Resampling.LANCZOS)
+            canvas = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+            mask = self._create_rounded_mask(width, height, SCALE)
+            canvas.paste(img, (0, 0), mask)
+            if SCALE > 1:
+                canvas = canvas.resize(layout.size, Image.Resampling.LANCZOS)
+            return canvas
+
+        if self.text_scale is not None:
+            canvas = self._render_bubble_nine_slice(layout, image)
+            if canvas is not None:
+                return canvas
+
+        # 超大气泡分段绘制，不分配整张超采样画布
+        if self._bubble_is_banded(layout):
+            return self._render_bubble_banded(layout, image)
+
+        # 创建画布
+        canvas = Image.new("RGBA", (layout.width, layout.height), (0, 0, 0, 0))
+        img_canvas = None
+        if layout.image_box is not None:
+            img_canvas = self._create_rounded_image(image, layout.image_box[2:], SCALE)
+        self._draw_bubble(canvas, layout, 0, img_canvas)
+
+        # 缩放到正常尺寸
+        return self._downsample(canvas, SCALE)
+
+    def _draw_bubble(self, canvas, layout, top, img_canvas=None):
+        """在超采样画布上绘制气泡中从第 top 行开始的部分"""
+        SCALE = layout.scale
         draw_canvas = ImageDraw.Draw(canvas)
 
         # 绘制气泡背景
         draw_canvas.rounded_rectangle(
-            (0, 0, width, height),
+            (0, -top, layout.width, layout.height - top),
             radius=self.corner_radius * SCALE,
             fill=self.bubble_bg_color,
-            outline=(230, 230, 230, 255),
+            outline=self.BUBBLE_OUTLINE,
             width=2 * SCALE
         )
 
-        # 绘制文本
-        if lines:
-            y = padding
-            for line in lines:
-                draw_canvas.text((padding, y), line, fill=self.text_color, font=font)
-                y += line_height + padding
-
-        # 粘贴图片
-        img_x = (width - img_canvas.width) // 2
-        img_y = text_height + padding * (2 + len(lines) if lines else 1)
-        canvas.paste(img_canvas, (img_x, img_y), img_canvas)
-
-        # 缩放到正常尺寸
-        return canvas.resize((width // SCALE, height // SCALE), Image.Resampling.LANCZOS)
-
-    def create_title_bubble(self, text, bg_color):
-        """创建头衔气泡"""
-        SCALE = self.SCALE
-        font = self.title_SCALE_font
+        # 绘制文本（跳过与画布不相交的行）
+        font_size = self._scaled_font('bubble', SCALE).size
+        for x, y, line in layout.lines:
+            if y - top > canvas.height or y - top + font_size * 2 < 0:
+                continue
+            self._draw_text(draw_canvas, (x, y - top), line, 'bubble', SCALE, self.text_color)
 
-        # 测量文本
-        draw = self._get_temp_draw()
-        text_width = int(draw.textlength(text, font=font))
+        # 粘贴图片（一次缩放到画布上的最终尺寸）
+        if img_canvas is not None:
+            img_x, img_y, _, _ = layout.image_box
+            canvas.paste(img_canvas, (img_x, img_y - top), img_canvas)
 
-        # 计算字体高度
-        bbox = font.getbbox(text)
-        text_height = bbox[3] - bbox[1] + 4 * SCALE
+    # ------------------------------------------------------------------------------
+    # 分段绘制：超大气泡按水平条带超采样并缩回1x，峰值内存只与条带高度有关
+    # ------------------------------------------------------------------------------
+    def _bubble_is_banded(self, layout):
+        """气泡是否走分段绘制（九宫格路径本身只分配1x画布，不需要分段）
 
-        # 计算尺寸
-        width = int(text_width + self.title_padding_x * 2)
-        height = int(text_height + self.title_padding_y * 3)
+        只有 high 预设会走到这里，分段缩放固定使用 LANCZOS
+        """
+        if layout.kind == "image" or self.text_scale is not None:
+            return False
+        return layout.width * layout.height > self.band_canvas_pixels
+
+    def _bubble_bands(self, layout, image=None):
+        """依次生成气泡1x结果的条带：(起始行, 条带图片)"""
+        SCALE = layout.scale
+        out_w, out_h = layout.size
+        img_canvas = None
+        if layout.image_box is not None:
+            img_canvas = self._create_rounded_image(image, layout.image_box[2:], SCALE)
+
+        # LANCZOS 在1x上的支撑半径为3行，条带上下各多画一些超采样行，保证接缝处与整图缩放一致
+        step_y = layout.height / out_h
+        margin = 3 * step_y + 2
+        for j0 in range(0, out_h, self.band_height):
+            j1 = min(j0 + self.band_height, out_h)
+            top = max(0, math.floor(j0 * step_y - margin))
+            bottom = min(layout.height, math.ceil(j1 * step_y + margin))
+            canvas = Image.new("RGBA", (layout.width, bottom - top), (0, 0, 0, 0))
+            self._draw_bubble(canvas, layout, top, img_canvas)
+            band = canvas.resize(
+                (out_w, j1 - j0),
+                Image.Resampling.LANCZOS,
+                box=(0, j0 * step_y - top, layout.width, j1 * step_y - top)
+            )
+            yield j0, band
+
+    def _render_bubble_banded(self, layout, image=None):
+        """分段绘制后拼成完整的1x气泡"""
+        bubble = Image.new("RGBA", layout.size, (0, 0, 0, 0))
+        for y, band in self._bubble_bands(layout, image):
+            bubble.paste(band, (0, y))
+        return bubble
+
+    def _message_bands(self, layout, image=None, avatar_path=None):
+        """依次生成整条消息1x结果的条带，气泡部分直接取自气泡条带"""
+        width, height = layout.size
+        bubble_x, bubble_y = layout.bubble_position
+        bubble_bands = self._bubble_bands(layout.bubble, image)
+        pending = None
+        header_bottom = max(
+            layout.avatar_position[1] + self.avatar_size[1],
+            bubble_y
+        ) + self.margin
+
+        for r0 in range(0, height, self.band_height):
+            r1 = min(r0 + self.band_height, height)
+            band = self._create_background_canvas(width, r1 - r0)
+
+            # 气泡：取出与本条带相交的气泡条带
+            while True:
+                if pending is None:
+                    pending = next(bubble_bands, None)
+                if pending is None:
+                    break
+                y, piece = pending
+                top = bubble_y + y
+                if top >= r1:
+                    break
+                band.paste(piece, (bubble_x, top - r0), piece)
+                if top + piece.height > r1:
+                    break
+                pending = None
+
+            # 头像、头衔与昵称只出现在开头几个条带
+            if r0 < header_bottom:
+                self._draw_message_header(band, layout, (0, -r0), avatar_path)
+            yield band
+
+    def _create_rounded_image(self, image, size, scale):
+        """将图片一次缩放到超采样画布上的目标尺寸并裁出圆角"""
+        img = self.load_bubble_image(image, scale)
+        if img.size != size:
+            img = img.resize(size, Image.Resampling.LANCZOS)
+
+        canvas = Image.new("RGBA", size, (0, 0, 0, 0))
+        mask = self._create_rounded_mask(size[0], size[1], scale)
+        canvas.paste(img, (0, 0), mask)
+        return canvas
 
-        # 创建气泡
-        canvas = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    def render_title(self, layout):
+        """按头衔布局绘制并缩回1x"""
+        SCALE = layout.scale
+        if self.text_scale is not None:
+            canvas = self._nine_slice(self._template(8, layout.color), layout.size)
+            if canvas is not None:
+                self._draw_text_layer(
+                    canvas, ((*layout.text_position, layout.text),), SCALE, 'title', (255, 255, 255, 255)
+                )
+                return canvas
+
+        canvas = Image.new("RGBA", (layout.width, layout.height), (0, 0, 0, 0))
         draw_canvas = ImageDraw.Draw(canvas)
 
         # 绘制背景
         draw_canvas.rounded_rectangle(
-            (0, 0, width, height),
+            (0, 0, layout.width, layout.height),
             radius=8 * SCALE,
-            fill=bg_color
+            fill=layout.color
         )
 
         # 绘制文本
-        draw_canvas.text(
-            (self.title_padding_x, self.title_padding_y_offset),
-            text,
-            fill=(255, 255, 255, 255),
-            font=font
-        )
+        self._draw_text(draw_canvas, layout.text_position, layout.text, 'title', SCALE, (255, 255, 255, 255))
 
         # 缩放到正常尺寸
-        return canvas.resize((width // SCALE, height // SCALE), Image.Resampling.LANCZOS)
+        return self._downsample(canvas, SCALE)
+
+    def render_message(self, layout, image=None, avatar_path=None):
+        """按消息布局绘制整张图片"""
+        background = self._create_background_canvas(*layout.size)
+        self._draw_message(background, layout, (0, 0), image, avatar_path)
+        return background
+
+    def _draw_message(self, background, layout, origin, image=None, avatar_path=None):
+        """把一条消息绘制到背景画布的 origin 处"""
+        def at(position):
+            return position[0] + origin[0], position[1] + origin[1]
+
+        # 添加气泡
+        bubble = self.render_bubble(layout.bubble, image)
+        background.paste(bubble, at(layout.bubble_position), bubble)
+        self._draw_message_header(background, layout, origin, avatar_path)
+
+    def _draw_message_header(self, background, layout, origin, avatar_path=None):
+        """绘制消息的头像、头衔与昵称"""
+        def at(position):
+            return position[0] + origin[0], position[1] + origin[1]
+
+        # 添加头像
+        self._add_avatar(background, avatar_path, at(layout.avatar_position))
+
+        # 添加头衔（使用缓存的徽章贴图）
+        if layout.title is not None:
+            title_bubble = self.title_sprite(layout.title.text, layout.title.color).image
+            background.paste(title_bubble, at(layout.title_position), title_bubble)
+
+        # 添加昵称
+        draw = ImageDraw.Draw(background)
+        self._draw_text(draw, at(layout.nickname_position), layout.nickname, 'nickname', 1, self.text_color)
+
+    def render_conversation(self, messages):
+        """把多条消息依次排版后绘制到同一张画布上
+
+        messages 为渲染描述列表（字段同 render_spec）；每张图片只解码一次，排版取其尺寸，
+        绘制时复用，画完一条即释放
+        """
+        images = [
+            self.load_bubble_image(message["image"]) if message.get("image") is not None else None
+            for message in messages
+        ]
+        inputs = []
+        for message, image in zip(messages, images):
+            inputs.append((
+                message["text"],
+                image.size if image is not None else None,
+                self._display_name(message["user_info"], message.get("title_info")),
+                message.get("title_info")
+            ))
+        layout = self.layout_conversation(inputs)
+        if layout.width * layout.height > self.max_conversation_pixels:
+            raise ConversationTooLargeError(
+                f"聊天记录画布过大: {layout.width}x{layout.height}，上限 {self.max_conversation_pixels} 像素"
+            )
+
+        background = self._create_background_canvas(*layout.size)
+        for index, ((message_layout, y), message) in enumerate(zip(layout.messages, messages)):
+            self._draw_message(
+                background, message_layout, (0, y), images[index], message["user_info"].get("avatar_path")
+            )
+            images[index] = None
+        return background
+
+    # ------------------------------------------------------------------------------
+    # 头衔徽章贴图缓存
+    # ------------------------------------------------------------------------------
+    def title_sprite(self, text, bg_color):
+        """头衔徽章贴图，按 (内容, 颜色, 字体, 倍率) 缓存"""
+        key = (text, bg_color, self._font_configs['title'], self.render_scale, self.text_scale)
+        with self._title_sprites_lock:
+            sprite = self._title_sprites.get(key)
+            if sprite is not None:
+                self._title_sprites.move_to_end(key)
+                self._title_sprite_stats["hits"] += 1
+                return sprite
+            self._title_sprite_stats["misses"] += 1
+
+        sprite = TitleSprite(
+            self.render_title(self.layout_title(text, bg_color)),
+            self._text_length(text, 'title', 1) + self.bubble_padding
+        )
+        with self._title_sprites_lock:
+            self._title_sprites[key] = sprite
+            self._title_sprites.move_to_end(key)
+            while len(self._title_sprites) > self.max_title_sprites:
+                self._title_sprites.popitem(last=False)
+        return sprite
+
+    def invalidate_title_sprites(self, text=None, bg_color=None):
+        """移除头衔贴图；不传参数时全部清空"""
+        with self._title_sprites_lock:
+            if text is None and bg_color is None:
+                self._title_sprites.clear()
+                return
+            for key in [k for k in self._title_sprites if k[0] == text and (bg_color is None or k[1] == bg_color)]:
+                del self._title_sprites[key]
+
+    def warm_title_sprites(self, title_infos):
+        """预先生成已知头衔的贴图，返回生成数量"""
+        warmed = 0
+        for title_info in title_infos:
+            title = self.resolve_title(title_info)
+            if title is None:
+                continue
+            try:
+                self.title_sprite(*title)
+                warmed += 1
+            except (TypeError, ValueError) as e:
+                logger.warning(f"头衔数据异常，跳过预热: {title_info}, 错误: {e}")
+        return warmed
+
+    def title_sprite_stats(self):
+        with self._title_sprites_lock:
+            return dict(self._title_sprite_stats, entries=len(self._title_sprites))
+
+    # ------------------------------------------------------------------------------
+    # 九宫格模板：背景在1x拼接，只有圆角需要超采样
+    # ------------------------------------------------------------------------------
+    def _template(self, radius, fill, outline=None, outline_width=0):
+        """预渲染的九宫格模板（1x），按圆角、填充色与描边缓存"""
+        key = (radius, fill, outline, outline_width)
+        template = self._templates.get(key)
+        if template is None:
+            SCALE = self.SCALE
+            corner = radius + self.TEMPLATE_MARGIN
+            side = (corner * 2 + 1) * SCALE
+            canvas = Image.new("RGBA", (side, side), (0, 0, 0, 0))
+            ImageDraw.Draw(canvas).rounded_rectangle(
+                (0, 0, side, side),
+                radius=radius * SCALE,
+                fill=fill,
+                outline=outline,
+                width=outline_width * SCALE
+            )
+            template = self._templates.setdefault(key, self._downsample(canvas, SCALE))
+        return template
+
+    def _warm_templates(self):
+        """启动时预渲染气泡与各颜色头衔的模板"""
+        self._template(self.corner_radius, self.bubble_bg_color, self.BUBBLE_OUTLINE, 2)
+        for color in self.color_map.values():
+            self._template(8, color)
+
+    def _nine_slice(self, template, size):
+        """用模板拼接指定尺寸的背景：四角原样粘贴，边条与中心拉伸；尺寸小于模板时返回 None"""
+        width, height = size
+        corner = (template.width - 1) // 2
+        if width < template.width or height < template.height:
+            return None
+        inner_w, inner_h = width - corner * 2, height - corner * 2
+        far_x, far_y = width - corner, height - corner
+        edge = corner + 1
+
+        canvas = Image.new("RGBA", size, (0, 0, 0, 0))
+        # 四角
+        canvas.paste(template.crop((0, 0, corner, corner)), (0, 0))
+        canvas.paste(template.crop((edge, 0, template.width, corner)), (far_x, 0))
+        canvas.paste(template.crop((0, edge, corner, template.height)), (0, far_y))
+        canvas.paste(template.crop((edge, edge, template.width, template.height)), (far_x, far_y))
+        # 四边与中心（模板中间一行 / 一列沿拉伸方向是均匀的）
+        stretch = Image.Resampling.NEAREST
+        canvas.paste(template.crop((corner, 0, edge, corner)).resize((inner_w, corner), stretch), (corner, 0))
+        canvas.paste(template.crop((corner, edge, edge, template.height)).resize((inner_w, corner), stretch), (corner, far_y))
+        canvas.paste(template.crop((0, corner, corner, edge)).resize((corner, inner_h), stretch), (0, corner))
+        canvas.paste(template.crop((edge, corner, template.width, edge)).resize((corner, inner_h), stretch), (far_x, corner))
+        canvas.paste(template.crop((corner, corner, edge, edge)).resize((inner_w, inner_h), stretch), (corner, corner))
+        return canvas
+
+    def _draw_text_layer(self, canvas, lines, layout_scale, kind, color):
+        """按 text_scale 绘制文字遮罩，缩回1x后以指定颜色叠加到画布上"""
+        if not lines:
+            return
+        text_scale = min(self.text_scale, layout_scale)
+        factor = text_scale / layout_scale
+        mask = Image.new("L", (canvas.width * text_scale, canvas.height * text_scale), 0)
+        draw_mask = ImageDraw.Draw(mask)
+        for x, y, line in lines:
+            self._draw_text(draw_mask, (x * factor, y * factor), line, kind, text_scale, 255)
+        mask = self._downsample(mask, text_scale)
+        canvas.paste(color, (0, 0, canvas.width, canvas.height), mask)
+
+    def _render_bubble_nine_slice(self, layout, image=None):
+        """九宫格背景 + 单独绘制的文字与1x图片；气泡小于模板时返回 None"""
+        SCALE = layout.scale
+        template = self._template(self.corner_radius, self.bubble_bg_color, self.BUBBLE_OUTLINE, 2)
+        canvas = self._nine_slice(template, layout.size)
+        if canvas is None:
+            return None
+
+        self._draw_text_layer(canvas, layout.lines, SCALE, 'bubble', self.text_color)
+
+        # 图片直接缩放到1x，仅圆角遮罩超采样
+        if layout.image_box is not None:
+            img_x, img_y, width, height = layout.image_box
+            size = (width // SCALE, height // SCALE)
+            img = self.load_bubble_image(image, SCALE)
+            if img.size != size:
+                img = img.resize(size, Image.Resampling.LANCZOS)
+            mask = self._downsample(self._create_rounded_mask(width, height, SCALE), SCALE)
+            img_canvas = Image.new("RGBA", size, (0, 0, 0, 0))
+            img_canvas.paste(img, (0, 0), mask)
+            canvas.paste(img_canvas, (img_x // SCALE, img_y // SCALE), img_canvas)
+        return canvas
+
+    # ------------------------------------------------------------------------------
+    # 气泡创建方法（布局 + 绘制）
+    # ------------------------------------------------------------------------------
+    def create_chat_bubble(self, text):
+        """创建纯文本聊天气泡"""
+        return self.render_bubble(self.layout_bubble(text))
+
+    def create_chat_img_bubble(self, image):
+        """创建纯图片聊天气泡"""
+        img = self.load_bubble_image(image)
+        return self.render_bubble(self.layout_bubble("", img.size), img)
+
+    def create_chat_text_img_bubble(self, text, image):
+        """创建图文混合聊天气泡"""
+        img = self.load_bubble_image(image)
+        return self.render_bubble(self.layout_bubble(text, img.size), img)
+
+    def create_title_bubble(self, text, bg_color):
+        """创建头衔气泡"""
+        return self.title_sprite(text, bg_color).image
+
+    def load_bubble_image(self, source, scale=None):
+        """读取气泡图片：限制字节数与像素数，按目标尺寸降采样解码，并统一色彩模式
+
+        source 可以是文件路径、bytes、文件对象或 PIL Image；超出限制时抛出 ValueError。
+        scale 默认为 self.SCALE：排版按该倍率下的图片尺寸计算，各质量预设的输出尺寸一致
+        """
+        if scale is None:
+            scale = self.SCALE
+        target_width = self.max_width * scale - self.bubble_padding * scale * 2
+
+        if isinstance(source, Image.Image):
+            img = source
+        else:
+            if isinstance(source, (bytes, bytearray, memoryview)):
+                size = len(source)
+                source = BytesIO(source)
+            elif isinstance(source, str):
+                size = os.path.getsize(source)
+            else:
+                data = source.read(self.max_image_bytes + 1)
+                size = len(data)
+                source = BytesIO(data)
+            if size > self.max_image_bytes:
+                raise ValueError(f"图片过大: {size} 字节，上限 {self.max_image_bytes} 字节")
+            try:
+                img = Image.open(source)
+            except Image.DecompressionBombError as e:
+                raise ValueError(f"图片像素数过多: {e}") from e
+
+        # 解码前检查像素数，防止解压炸弹
+        width, height = img.size
+        if width * height > self.max_image_pixels:
+            raise ValueError(f"图片像素数过多: {width}x{height}，上限 {self.max_image_pixels}")
+
+        # JPEG 直接以接近目标的尺寸解码（draft 只会按 2 的幂缩小且不小于请求尺寸）
+        if img.format == "JPEG" and width > target_width * 2:
+            ratio = target_width / width
+            img.draft(img.mode, (target_width, max(1, int(height * ratio))))
+
+        # 按 EXIF 方向旋正
+        if img.getexif().get(0x0112, 1) != 1:
+            img = ImageOps.exif_transpose(img)
+
+        # 远大于目标时先整数倍缩小，保留至少两倍余量供后续 LANCZOS 缩放
+        factor = img.width // (target_width * 2)
+        if factor >= 2:
+            img = img.reduce(factor)
+
+        # 统一色彩模式
+        if img.mode not in ("RGB", "RGBA"):
+            has_alpha = img.mode in ("LA", "PA", "La") or "transparency" in img.info
+            img = img.convert("RGBA" if has_alpha else "RGB")
+        img.load()
+        return img
 
     # ------------------------------------------------------------------------------
     # 主要接口（保持签名不变）
@@ -738,145 +3335,216 @@ class ChatBubbleGenerator:
             raise ValueError("需要提供user_info参数，避免同步HTTP调用")
 
         # 提取用户信息
-        nickname = user_info.get("name", "未知用户")
         avatar_path = user_info.get("avatar_path")
 
-        # 选择合适的气泡类型
-        if text and not image:
-            bubble = self.create_chat_bubble(text)
-        elif image and not text:
-            bubble = self.create_chat_img_bubble(image)
-        elif text and image:
-            bubble = self.create_chat_text_img_bubble(text, image)
-        else:
-            # 空消息，创建一个最小气泡
-            bubble = self.create_chat_bubble(" ")
-
-        # 处理头衔信息
-        title_info = None
-        if qq_title_key and qq in qq_title_key:
-            title_info = qq_title_key[qq]
-            # 优先使用备注名
-            if title_info.get("notes"):
-                nickname = title_info["notes"]
+        # 读取并规整图片输入
+        if image is not None:
+            image = self.load_bubble_image(image)
 
-        # 计算布局尺寸
-        bg_size = self._calculate_background_size(bubble, nickname, title_info)
-        background = self._create_background_canvas(*bg_size)
+        # 处理头衔信息（优先使用备注名）
+        title_info = qq_title_key.get(qq) if qq_title_key else None
+        nickname = self._display_name(user_info, title_info)
 
-        # 添加气泡
-        background.paste(bubble, self.bubble_position, bubble)
-
-        # 添加头像
-        self._add_avatar(background, avatar_path)
+        # 布局（按输入缓存）后绘制
+        layout = self.layout_message(
+            text,
+            image.size if image is not None else None,
+            nickname,
+            title_info
+        )
+        # 超大气泡且输出为 PNG 时逐条带绘制并直接编码
+        if self.output_format in ("png", "png_fast") and self._bubble_is_banded(layout.bubble):
+            return self._encode_message_stream(layout, image, avatar_path)
 
-        # 添加昵称和头衔
-        self._add_name_and_title(background, nickname, title_info)
+        background = self.render_message(layout, image, avatar_path)
 
         # 返回字节流
-        img_bytes = BytesIO()
-        background.save(img_bytes, format='PNG', optimize=True)
-        img_bytes.seek(0)
-        return img_bytes
+        return self.encode_image(background)
+
+    @staticmethod
+    def _display_name(user_info, title_info=None):
+        """显示名：设置了备注名时优先使用备注名"""
+        if title_info and title_info.get("notes"):
+            return title_info["notes"]
+        return user_info.get("name", "未知用户")
+
+    def render_spec(self, spec):
+        """按渲染描述生成图片并返回编码后的字节（可跨进程传递）
+
+        spec 字段：qq、text、image（图片字节或已解码图片，可为空）、
+        title_info（该QQ的头衔 / 备注，可为空）、user_info（name、avatar_path）；
+        含 messages 字段时为聊天记录，messages 中每一项为上述字段
+        """
+        if "messages" in spec:
+            background = self.render_conversation(spec["messages"])
+            return self.encode_image(background).getvalue()
+
+        title_info = spec.get("title_info")
+        img_bytes = self.create_chat_message(
+            qq=spec["qq"],
+            text=spec["text"],
+            image=spec.get("image"),
+            qq_title_key={spec["qq"]: title_info} if title_info else None,
+            user_info=spec["user_info"]
+        )
+        return img_bytes.getvalue()
 
     # ------------------------------------------------------------------------------
-    # 辅助方法
+    # 输出编码
     # ------------------------------------------------------------------------------
-    def _calculate_background_size(self, bubble, nickname, title_info=None):
-        """计算背景画布尺寸"""
-        bubble_w, bubble_h = bubble.size
+    def encode_image(self, image):
+        """按 output_format 编码最终图片，记录各格式的耗时与体积"""
+        started = time.perf_counter()
+        output_format = self.output_format
+        img_bytes = BytesIO()
+        if output_format == "png_palette":
+            palette_image = self._quantize_palette(image)
+            if palette_image is None:
+                output_format = "png_fast"
+            else:
+                palette_image.save(
+                    img_bytes, format='PNG',
+                    compress_level=self.png_compress_level,
+                    transparency=palette_image.info["transparency"]
+                )
+        if output_format == "png":
+            image.save(img_bytes, format='PNG', optimize=True)
+        elif output_format == "png_fast":
+            image.save(img_bytes, format='PNG', compress_level=self.png_compress_level)
+        elif output_format == "webp":
+            if self.output_quality >= 100:
+                image.save(img_bytes, format='WEBP', lossless=True)
+            else:
+                image.save(img_bytes, format='WEBP', quality=self.output_quality, method=4)
+        elif output_format == "jpeg":
+            # JPEG 不支持透明度，合成到背景色上
+            flat = Image.new("RGBA", image.size, self.background_color)
+            flat.alpha_composite(image)
+            flat.convert("RGB").save(img_bytes, format='JPEG', quality=self.output_quality)
+        self._record_encode(output_format, time.perf_counter() - started, img_bytes.tell())
+        img_bytes.seek(0)
+        return img_bytes
 
-        # 测量文本宽度
-        draw = self._get_temp_draw()
-        nickname_width = draw.textlength(nickname, font=self.nickname_font) + self.bubble_padding
+    def _encode_message_stream(self, layout, image=None, avatar_path=None):
+        """逐条带绘制消息并写入流式 PNG，编码耗时单独记为 png_stream"""
+        compress_level = 9 if self.output_format == "png" else self.png_compress_level
+        writer = PngStreamWriter(*layout.size, compress_level=compress_level)
+        elapsed = 0.0
+        for band in self._message_bands(layout, image, avatar_path):
+            started = time.perf_counter()
+            writer.write(band)
+            elapsed += time.perf_counter() - started
+        started = time.perf_counter()
+        img_bytes = writer.finish()
+        elapsed += time.perf_counter() - started
+        self._record_encode("png_stream", elapsed, len(img_bytes.getbuffer()))
+        return img_bytes
 
-        # 计算基础宽度
-        width_candidates = [
-            self.bubble_position[0] + bubble_w + self.margin,
-            self.avatar_position[0] + self.avatar_size[0] + self.margin,
-            self.bubble_position[0] + nickname_width
-        ]
+    def _quantize_palette(self, image):
+        """量化为 256 色调色板，每个调色板项的透明度取映射到它的像素的平均值；
+        颜色过多（照片类内容）时返回 None"""
+        if image.getcolors(self.PALETTE_MAX_SOURCE_COLORS) is None:
+            return None
+        palette_image = image.convert("RGB").quantize(
+            256, method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE
+        )
+        # 按 (调色板索引, 透明度) 组合计数，避免逐像素遍历
+        index_band = Image.frombytes("L", palette_image.size, palette_image.tobytes())
+        pairs = Image.merge("LA", (index_band, image.getchannel("A"))).getcolors(65536)
+        alpha_sums = [0] * 256
+        counts = [0] * 256
+        for count, (index, alpha) in pairs:
+            alpha_sums[index] += alpha * count
+            counts[index] += count
+        palette_image.info["transparency"] = bytes(
+            round(alpha_sums[i] / counts[i]) if counts[i] else 255 for i in range(256)
+        )
+        return palette_image
 
-        # 如果有头衔，调整宽度
-        if title_info:
-            title_width = draw.textlength(
-                title_info.get("content", ""),
-                font=self.title_font
-            ) + self.bubble_padding
-            width_candidates.append(
-                self.bubble_position[0] + nickname_width + title_width + self.title_bubble_name_offset
+    def _record_encode(self, output_format, elapsed, size):
+        with self._encode_stats_lock:
+            stats = self._encode_stats.setdefault(
+                output_format, {"count": 0, "time_total": 0.0, "time_max": 0.0, "bytes_total": 0}
             )
+            stats["count"] += 1
+            stats["time_total"] += elapsed
+            stats["time_max"] = max(stats["time_max"], elapsed)
+            stats["bytes_total"] += size
+
+    def encode_stats(self):
+        """各输出格式的编码次数、平均耗时（毫秒）与平均体积（字节）"""
+        with self._encode_stats_lock:
+            return {
+                output_format: {
+                    "count": stats["count"],
+                    "avg_ms": round(stats["time_total"] / stats["count"] * 1000, 2),
+                    "max_ms": round(stats["time_max"] * 1000, 2),
+                    "avg_bytes": stats["bytes_total"] // stats["count"]
+                }
+                for output_format, stats in self._encode_stats.items()
+            }
 
-        # 计算高度
-        height_candidates = [
-            self.bubble_position[1] + bubble_h + self.margin,
-            self.avatar_position[1] + self.avatar_size[1] + self.margin
-        ]
-
-        return int(max(width_candidates)), int(max(height_candidates))
-
+    # ------------------------------------------------------------------------------
+    # 辅助方法
+    # ------------------------------------------------------------------------------
     def _create_background_canvas(self, width, height):
         """创建背景画布"""
         return Image.new("RGBA", (width, height), self.background_color)
 
-    def _add_avatar(self, background, avatar_path):
+    def _add_avatar(self, background, avatar_path, position=None):
         """添加头像到背景"""
+        if position is None:
+            position = self.avatar_position
         try:
-            if avatar_path and os.path.exists(avatar_path):
-                avatar = Image.open(avatar_path).convert("RGBA")
-                avatar = avatar.resize(self.avatar_size, Image.Resampling.LANCZOS)
-                background.paste(avatar, self.avatar_position, avatar)
+            avatar = None
+            if avatar_path:
+                avatar_path = self._resolve_avatar_mip(avatar_path)
+                avatar = self.avatar_tiles.get(avatar_path, self.avatar_size)
+            if avatar is not None:
+                background.paste(avatar, position, avatar)
             else:
-                self._create_default_avatar(background)
+                self._create_default_avatar(background, position)
         except Exception as e:
             logger.error(f"加载头像失败: {e}")
-            self._create_default_avatar(background)
+            self._create_default_avatar(background, position)
+
+    def avatar_mip_sizes(self):
+        """头像分级存储的尺寸：1x 与 SCALE 倍"""
+        if not self.avatar_mipmap:
+            return None
+        side = max(self.avatar_size)
+        return (side, side * self.SCALE)
+
+    def _resolve_avatar_mip(self, avatar_path):
+        """返回与渲染尺寸一致的头像分级文件，缺失或过期时由原图生成"""
+        if not self.avatar_mipmap:
+            return avatar_path
+        side = max(self.avatar_size)
+        mip_path = avatar_mip_path(avatar_path, side)
+        try:
+            source_mtime = os.stat(avatar_path).st_mtime_ns
+        except OSError:
+            return avatar_path
+        try:
+            if os.stat(mip_path).st_mtime_ns >= source_mtime:
+                return mip_path
+        except OSError:
+            pass
+        try:
+            with Image.open(avatar_path) as img:
+                level = img.convert("RGBA")
+            if level.size != (side, side):
+                level = level.resize((side, side), Image.Resampling.LANCZOS)
+            save_image_atomic(level, mip_path)
+            return mip_path
+        except OSError as e:
+            logger.warning(f"生成头像分级文件失败: {e}")
+            return avatar_path
 
-    def _create_default_avatar(self, background):
+    def _create_default_avatar(self, background, position=None):
         """创建默认头像"""
         default_avatar = Image.new("RGBA", self.avatar_size, (200, 200, 200, 255))
-        background.paste(default_avatar, self.avatar_position)
-
-    def _add_name_and_title(self, background, nickname, title_info=None):
-        """添加昵称和头衔到背景"""
-        draw = ImageDraw.Draw(background)
-
-        if title_info:
-            # 处理头衔
-            title_color = self.color_map.get(
-                int(title_info.get("color", 1)),
-                self.color_map[1]
-            )
-            title_content = title_info.get("content", "")
-
-            # 创建头衔气泡
-            title_bubble = self.create_title_bubble(title_content, title_color)
-            background.paste(
-                title_bubble,
-                (self.bubble_position[0], self.avatar_position[1] + self.title_bubble_offset),
-                title_bubble
-            )
-
-            # 测量头衔宽度
-            draw_temp = self._get_temp_draw()
-            title_width = draw_temp.textlength(title_content, font=self.title_font) + self.bubble_padding
-
-            # 绘制昵称
-            name_x = self.bubble_position[0] + title_width + self.title_bubble_name_offset
-            draw.text(
-                (name_x, self.avatar_position[1]),
-                nickname,
-                fill=self.text_color,
-                font=self.nickname_font
-            )
-        else:
-            # 只绘制昵称
-            draw.text(
-                (self.bubble_position[0], self.avatar_position[1]),
-                nickname,
-                fill=self.text_color,
-                font=self.nickname_font
-            )
+        background.paste(default_avatar, self.avatar_position if position is None else position)
 
 # ------------------------------------------------------------------------------
 # 辅助函数
@@ -893,8 +3561,32 @@ def extract_help_parameters(s, directive):
         return [first_param, remaining_text] if remaining_text else [first_param]
     return []
 
-async def get_qq_info(qq, avatar_cache_location=".", http_client=None):
-    """异步获取QQ信息（缓存 + API）"""
+def extract_chat_entries(s, directive):
+    """提取聊天记录指令中的消息，每行一条：[QQ号] [消息内容]，返回 [(qq, text), ...]"""
+    match = re.search(re.escape(directive) + r'(.*)', s, re.DOTALL)
+    if not match:
+        return []
+    entries = []
+    for line in match.group(1).splitlines():
+        parts = line.strip().split(None, 1)
+        if parts:
+            entries.append((parts[0], parts[1] if len(parts) > 1 else ""))
+    return entries
+
+async def get_qq_info(
+        qq,
+        avatar_cache_location=".",
+        http_client=None,
+        user_store=None,
+        mip_sizes=None,
+        nickname_resolver=None,
+        refresh=False
+):
+    """异步获取QQ信息（缓存 + API）
+
+    使用 user_store 时，过期的缓存仍会返回并带上 "stale": True，由调用方决定是否后台刷新；
+    refresh=True 时跳过缓存重新获取，头像使用条件请求，获取失败则保留原有记录。
+    """
     # 验证QQ号
     if not qq or not isinstance(qq, str) or not qq.isdigit():
         logger.warning(f"无效的QQ号格式: {qq}")
@@ -904,14 +3596,16 @@ async def get_qq_info(qq, avatar_cache_location=".", http_client=None):
     os.makedirs(avatar_cache_location, exist_ok=True)
 
     # 先检查缓存
-    for filename in os.listdir(avatar_cache_location):
-        if filename.startswith(f"{qq}-") and filename.endswith(".png"):
-            nickname = filename[len(f"{qq}-"):-4]
-            return {
-                "qq": qq,
-                "name": nickname,
-                "avatar_path": os.path.join(avatar_cache_location, filename)
-            }
+    cached = None
+    if user_store is not None:
+        cached, fresh = user_store.lookup(qq)
+        if cached and not refresh:
+            if not fresh:
+                cached["stale"] = True
+            return cached
+        if not cached and user_store.is_negative(qq):
+            logger.debug(f"QQ信息查询处于失败冷却期: {qq}")
+            return None
 
     # 需要HTTP客户端
     if http_client is None:
@@ -920,85 +3614,164 @@ async def get_qq_info(qq, avatar_cache_location=".", http_client=None):
 
     # 异步请求API
     try:
-        # 备用API列表
-        apis = [
-            f"https://uapis.cn/api/v1/social/qq/userinfo?qq={qq}",
-            f"https://api.mmp.cc/api/qqname?qq={qq}",
-            f"https://api.uomg.com/api/qq.info?qq={qq}",
-            # 可以添加更多备用API
-        ]
+        if nickname_resolver is None:
+            nickname_resolver = NicknameResolver()
 
-        nickname = qq  # 如果API访问失败,使用qq当默认值,让用户使用提供的备注接口修改名称
-        avatar_url = f"https://q1.qlogo.cn/g?b=qq&nk={qq}&s=640"
+        # 刷新时带上次的校验信息发起条件请求
+        etag = last_modified = None
+        if cached and user_store is not None:
+            etag, last_modified = user_store.validators(qq)
 
-        # 尝试多个API
-        for api_url in apis:
-            try:
-                response = await http_client.get(api_url, timeout=10.0)
-                if response.status_code == 200:
-                    data = response.json()
-                    # 尝试解析不同API的响应格式
-                    if "data" in data and "name" in data["data"]:
-                        nickname = data["data"]["name"]
-                        break
-                    elif "name" in data:
-                        nickname = data["name"]
-                        break
-                    elif "nickname" in data:
-                        nickname = data["nickname"]
-                        break
-                nickname = clean_filename_for_platform(nickname)
-            except Exception as e:
-                logger.debug(f"API请求失败 {api_url}: {e}")
-                continue
+        # 昵称与头像同时获取（头像地址只依赖QQ号）
+        avatar_url = f"https://q1.qlogo.cn/g?b=qq&nk={qq}&s=640"
+        resolved, fetched = await asyncio.gather(
+            nickname_resolver.resolve(qq, http_client),
+            fetch_avatar(avatar_url, http_client, mip_sizes=mip_sizes, etag=etag, last_modified=last_modified)
+        )
 
-        # 下载头像
-        save_path = os.path.join(avatar_cache_location, f"{qq}-{nickname}.png")
-        success = await download_circular_avatar(avatar_url, save_path, http_client)
+        # 如果API访问失败,使用qq当默认值,让用户使用提供的备注接口修改名称；刷新失败时沿用旧昵称
+        if resolved:
+            nickname = resolved.strip() or qq
+        else:
+            nickname = cached["name"] if cached else qq
+
+        # 头像按QQ号存放，与昵称无关
+        save_path = avatar_store_path(avatar_cache_location, qq)
+        avatar_hash = None
+        if fetched["image"] is not None:
+            avatar_hash = await asyncio.to_thread(save_circular_avatar, fetched["image"], save_path, mip_sizes)
+            success = avatar_hash is not None
+        elif cached:
+            # 头像未变化或刷新失败：沿用原文件
+            success = fetched["not_modified"]
+            avatar_hash = cached.get("avatar_hash")
+        else:
+            success = False
 
-        if not success:
+        if not success and not cached:
             logger.warning(f"下载头像失败: {qq}")
             # 创建默认头像
             create_default_avatar(qq, nickname, save_path)
 
+        if user_store is not None:
+            user_store.put(
+                qq,
+                nickname,
+                ok=bool(resolved) and success,
+                etag=fetched["etag"] or etag,
+                last_modified=fetched["last_modified"] or last_modified,
+                avatar_hash=avatar_hash
+            )
+            await user_store.save()
+
         return {
             "qq": qq,
             "name": nickname,
-            "avatar_path": save_path
+            "avatar_path": save_path,
+            "avatar_hash": avatar_hash
         }
 
     except Exception as e:
         logger.error(f"获取QQ信息失败: {e}")
+        if user_store is not None:
+            user_store.mark_failure(qq)
         return None
 
-async def download_circular_avatar(url, save_path, http_client=None, size=None):
-    """异步下载并裁剪头像为圆形"""
+def parse_avatar_filename(filename):
+    """解析头像缓存文件名 {qq}-{nickname}.png，返回 (qq, nickname)"""
+    match = re.match(r'^(\d+)-(.*)\.png$', filename, re.DOTALL)
+    if not match:
+        return None
+    return match.group(1), match.group(2)
+
+async def fetch_avatar(url, http_client=None, size=None, mip_sizes=None, etag=None, last_modified=None):
+    """异步下载头像并裁剪为圆形，支持 ETag / Last-Modified 条件请求
+
+    返回 {"image", "not_modified", "etag", "last_modified"}，下载失败或未变化时 image 为 None
+    """
+    fetched = {"image": None, "not_modified": False, "etag": None, "last_modified": None}
     if http_client is None:
         logger.error("HTTP客户端未初始化")
-        return False
+        return fetched
+
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
 
     try:
-        response = await http_client.get(url, timeout=15.0)
+        response = await http_client.get(url, headers=headers, timeout=15.0)
+        if response.status_code == 304:
+            fetched["not_modified"] = True
+            return fetched
         response.raise_for_status()
+        fetched["etag"] = response.headers.get("ETag")
+        fetched["last_modified"] = response.headers.get("Last-Modified")
 
-        # 加载图片
-        img_data = response.content
-        img = Image.open(BytesIO(img_data)).convert("RGBA")
-
-        # 创建圆形头像
-        result = create_circular_avatar(img, size)
-
-        # 保存头像
-        result.save(save_path)
-        logger.debug(f"头像已保存: {save_path}")
-        return True
+        # 创建圆形头像（分级存储时原图只保留最大一级）
+        if mip_sizes and size is None:
+            size = max(mip_sizes)
+        fetched["image"] = await asyncio.to_thread(decode_circular_avatar, response.content, size)
 
     except httpx.RequestError as e:
         logger.error(f"下载头像请求失败: {e}")
     except Exception as e:
         logger.error(f"处理头像失败: {e}")
 
-    return False
+    return fetched
+
+def decode_circular_avatar(img_data, size=None):
+    """解码头像数据并裁剪为圆形"""
+    img = Image.open(BytesIO(img_data)).convert("RGBA")
+    return create_circular_avatar(img, size)
+
+def save_circular_avatar(result, save_path, mip_sizes=None):
+    """保存圆形头像及其余分级，返回头像文件的 sha256，失败时返回 None"""
+    try:
+        buffer = BytesIO()
+        result.save(buffer, format="PNG")
+        data = buffer.getvalue()
+        write_file_atomic(save_path, data)
+        logger.debug(f"头像已保存: {save_path}")
+
+        for mip_size in mip_sizes or ():
+            if mip_size != result.width:
+                level = result.resize((mip_size, mip_size), Image.Resampling.LANCZOS)
+                save_image_atomic(level, avatar_mip_path(save_path, mip_size))
+        return hashlib.sha256(data).hexdigest()
+    except Exception as e:
+        logger.error(f"保存头像失败: {e}")
+        return None
+
+def avatar_store_path(avatar_dir, qq):
+    """头像存放路径：按QQ号末两位分片，避免单个目录文件过多"""
+    return os.path.join(avatar_dir, "store", qq[-2:].rjust(2, "0"), f"{qq}.png")
+
+def avatar_mip_path(avatar_path, size):
+    """头像分级文件路径：{目录}/mip/{尺寸}/{文件名}"""
+    directory, filename = os.path.split(avatar_path)
+    return os.path.join(directory, "mip", str(size), filename)
+
+def save_image_atomic(image, save_path, **params):
+    """先写临时文件再替换，避免并发读取到写了一半的图片"""
+    buffer = BytesIO()
+    image.save(buffer, format=params.pop("format", "PNG"), **params)
+    write_file_atomic(save_path, buffer.getvalue())
+
+def write_file_atomic(path, data):
+    """写入同目录临时文件后重命名，保证文件要么是旧内容要么是完整的新内容"""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
 
 def create_circular_avatar(img, size=None):
     """将图片裁剪为圆形"""
@@ -1051,7 +3824,7 @@ def create_default_avatar(qq, nickname, save_path):
 
         # 转换为圆形并保存
         circular = create_circular_avatar(img.convert("RGBA"))
-        circular.save(save_path)
+        save_image_atomic(circular, save_path)
         return True
     except Exception as e:
         logger.error(f"创建默认头像失败: {e}")
@@ -1062,6 +3835,12 @@ def resize_by_scale(image, scale_factor):
     w, h = image.size
     return image.resize((int(w * scale_factor), int(h * scale_factor)), Image.Resampling.LANCZOS)
 
+def digest_bytes(data):
+    """字节内容的 SHA-256 摘要，data 为 None 时返回 None"""
+    if data is None:
+        return None
+    return hashlib.sha256(data).hexdigest()
+
 def image_to_base64(image_obj, format="PNG") -> str:
     """将PIL Image对象转换为Base64字符串"""
     img_buffer = BytesIO()
@@ -1069,24 +3848,3 @@ def image_to_base64(image_obj, format="PNG") -> str:
     img_bytes = img_buffer.getvalue()
     base64_str = base64.b64encode(img_bytes).decode("utf-8")
     return base64_str
-
-def clean_filename_for_platform(filename, replace_char='_'):
-    current_os = platform.system()
-    filename = unicodedata.normalize('NFKD', filename)
-    filename = re.sub(r'[\x00-\x1f\x7f-\x9f]', '', filename)
-    if current_os == 'Windows':
-        # Windows特定处理
-        illegal = r'[<>:"/\\|?*]'
-        max_len = 260
-    elif current_os == 'Darwin':  # macOS
-        illegal = r'[/:]'
-        max_len = 255
-    else:  # Linux/Unix
-        illegal = r'[/]'
-        max_len = 255
-    filename = re.sub(illegal, replace_char, filename)
-    filename = filename.strip('. ')
-    if len(filename.encode('utf-8')) > max_len:
-        encoded = filename.encode('utf-8')[:max_len]
-        filename = encoded.decode('utf-8', 'ignore').rstrip('\x00')
-    return filename if filename else "unnamed"
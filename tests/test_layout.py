@@ -0,0 +1,30 @@
+import os
+import sys
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+pytest.importorskip("astrbot")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import ChatBubbleGenerator  # noqa: E402
+
+
+def make_generator(render_quality):
+    # 纯图片气泡的排版不需要字体
+    return ChatBubbleGenerator("", "", "", "", render_quality=render_quality)
+
+
+@pytest.mark.parametrize("size", [(300, 200), (1200, 900), (4000, 3000)])
+def test_image_bubble_size_is_independent_of_quality(size):
+    buffer = BytesIO()
+    Image.new("RGB", size, (200, 50, 50)).save(buffer, "JPEG")
+    data = buffer.getvalue()
+
+    sizes = {}
+    for quality in ChatBubbleGenerator.QUALITY_PRESETS:
+        generator = make_generator(quality)
+        image = generator.load_bubble_image(data)
+        sizes[quality] = generator.layout_bubble("", image.size).size
+    assert sizes["fast"] == sizes["high"] == sizes["balanced"]